@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Renders pathological lines, such as long runs of [ or [[span]], at two
+sizes, with the default limits and with the limits lifted, and reports
+how the time grows.  Roughly 4x for 4x the input is linear; a growth
+above SUPERLINEAR is flagged.  Then renders random lines drawn from
+markup fragments, as a fuzz test of the limits; lines which the parser
+rejects, such as nested colors, are counted.  Each fuzzed line is also
+followed by a probe line, in a paragraph and in a list, and rendered
+with a small max_line_tokens: the probe must come out escaped whenever
+it does with the limits lifted, or markup cut off by the limit has
+leaked into the next line.
+"""
+
+import contextlib
+import io
+import random
+import time
+
+import common
+import wikidot_to_html
+
+CASES = [
+    ('open brackets', '['),
+    ('double brackets', '[[a'),
+    ('single brackets', '[#a'),
+    ('triple brackets', '[[[a|'),
+    ('link heads', '[http://a'),
+    ('literals', '@@x'),
+    ('entities', '@<'),
+    ('spans', '[[span a]]'),
+    ('sizes', '[[size 1]]'),
+    ('markers', '**//__--,,'),
+    ('minified', 'function(a){return a[0]||b>c&&d<e}'),
+    ('urls', 'http://a.b/'),
+]
+SIZE = 40000
+GROWTH = 4
+SUPERLINEAR = 6.0
+FRAGMENTS = ['[', ']', '[[', ']]', '[[[', '|', '@@', '@<', '>@', '**', '//', '--', '__', ',,', '^^',
+             '{{', '}}', '##', '##red|', '[[span a]]', '[[/span]]', '[[size 1]]', '[[/size]]',
+             'http://a.b/', '#a', ' ', 'word', '[!--', '--]']
+FUZZ_LINES = 2000
+FUZZ_LINE_FRAGMENTS = 200
+FUZZ_MAX_LINE_TOKENS = 50
+PROBE = '<probe> & x'
+PROBE_HTML = '&lt;probe&gt; &amp; x'
+PROBE_TEMPLATES = ['{}\n{}\n', '* {}\n* {}\n']
+
+
+def elapsed(renderer, text):
+    return common.best_of(lambda: renderer.render(text), 1)
+
+
+def probe_renders(renderer, line):
+    """
+    Whether the probe is rendered as escaped text after *line*, for
+    each of PROBE_TEMPLATES, or None where the page is rejected.
+    """
+    results = []
+    for template in PROBE_TEMPLATES:
+        try:
+            results.append(PROBE_HTML in renderer.render(template.format(line, PROBE)))
+        except Exception:  # pylint: disable=broad-except
+            results.append(None)
+
+    return results
+
+
+def main():
+    renderers = [
+        ('limits', wikidot_to_html.Renderer()),
+        ('no limits', wikidot_to_html.Renderer(max_line_length=10 ** 9, max_line_tokens=10 ** 9)),
+    ]
+    for name, unit in CASES:
+        for renderer_name, renderer in renderers:
+            small = unit * (SIZE // len(unit))
+            t1 = elapsed(renderer, small)
+            t2 = elapsed(renderer, small * GROWTH)
+            flag = '  SUPERLINEAR' if t2 / t1 > SUPERLINEAR else ''
+            print('{:<16} {:<10} {:>8} chars {:8.3f}s  x{} chars {:8.3f}s  growth {:5.1f}{}'.format(
+                name, renderer_name, len(small), t1, GROWTH, t2, t2 / t1, flag))
+
+    rnd = random.Random(17)
+    renderer = wikidot_to_html.Renderer()
+    cut_renderer = wikidot_to_html.Renderer(max_line_tokens=FUZZ_MAX_LINE_TOKENS)
+    uncut_renderer = wikidot_to_html.Renderer(max_line_tokens=10 ** 9)
+    size = seconds = error_cnt = leak_cnt = 0
+    with contextlib.redirect_stderr(io.StringIO()):
+        for _ in range(FUZZ_LINES):
+            line = ''.join(rnd.choice(FRAGMENTS) for _ in range(FUZZ_LINE_FRAGMENTS))
+            size += len(line)
+            start = time.perf_counter()
+            try:
+                renderer.render(line)
+            except Exception:  # pylint: disable=broad-except
+                error_cnt += 1
+            seconds += time.perf_counter() - start
+            for cut, uncut in zip(probe_renders(cut_renderer, line), probe_renders(uncut_renderer, line)):
+                if uncut and not cut:
+                    leak_cnt += 1
+                    if leak_cnt == 1:
+                        print('LEAK after {!r}'.format(line))
+    print('{:<27} {:>8} chars {:8.3f}s  {:6.2f} MB/sec  {} of {} lines rejected'.format(
+        'fuzz', size, seconds, size / seconds / 1e6, error_cnt, FUZZ_LINES))
+    print('{:<27} {} of {} probes leaked{}'.format(
+        'fuzz cut at {} tokens'.format(FUZZ_MAX_LINE_TOKENS), leak_cnt, FUZZ_LINES * len(PROBE_TEMPLATES),
+        '  LEAK' if leak_cnt else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Renders generic blocks of a growing number of lines, headings
+continued with " _", and reports how the time and the output grow.
+Roughly 2x for 2x the lines is linear; a growth above SUPERLINEAR is
+flagged.
+"""
+
+import common
+
+SIZES = [250, 500, 1000, 2000, 4000]
+SUPERLINEAR = 3.0
+
+
+def continued_heading(lines):
+    return '+ Heading _\n' + ''.join('line {} with **bold** text _\n'.format(n) for n in range(lines - 2)) + 'end\n'
+
+
+def main():
+    last = None
+    for lines in SIZES:
+        text = continued_heading(lines)
+        t = common.best_of(lambda: common.render(text))  # pylint: disable=cell-var-from-loop
+        size = len(common.render(text))
+        growth = '' if last is None else 'growth {:5.1f}{}'.format(
+            t / last, '  SUPERLINEAR' if t / last > SUPERLINEAR else '')
+        print('{:>6} lines  {:8.4f}s  {:>9} chars out  {}'.format(lines, t, size, growth))
+        last = t
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Helpers shared by the benchmarks in this directory.
+
+Run a benchmark from the top of the repository, e.g.
+
+    python3 bench/toc.py
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import wikidot_to_html  # noqa: E402  pylint: disable=wrong-import-position
+
+SECTION = '''+ Section {n}
+
+Some //italic// and **bold** text with a [http://example.com/{n} link] and
+a [[[page-{n}|wiki link]]] plus {{{{fixed width}}}} and --strike-- text.
+
+* first item
+* second item with __underline__
+ * nested item
+
+||~ name||~ value||
+||alpha||{n}||
+||beta||@@literal@@||
+
+++ Subsection {n}
+
+[[code]]
+for i in range({n}):
+    print(i < 10 and "small" or "big")
+[[/code]]
+
+'''
+
+
+PROSE_LINE = ('Plain prose with a comma, a number like {n} and the odd //italic// or **bold** '
+              'word, running on for a while as paragraphs do.')
+LINK_LINE = ('See [http://example.com/{n} the site], [[[page-{n}|the page]]], [[[other-{n}]]], '
+             'http://example.org/{n}/path and [#anchor-{n} the anchor].')
+
+
+def prose_page(lines):
+    return ''.join(PROSE_LINE.format(n=n) + ('\n\n' if n % 5 == 4 else '\n') for n in range(lines))
+
+
+def wide_table_page(rows, columns=30):
+    return ''.join('||' + '||'.join('cell {} {} **b**'.format(row, column) for column in range(columns)) + '||\n'
+                   for row in range(rows))
+
+
+def deep_list_page(items, depth=12):
+    return ''.join(' ' * (n % depth) + '* item {} with __underline__\n'.format(n) for n in range(items))
+
+
+def code_page(lines, block_size=40):
+    blocks = []
+    for start in range(0, lines, block_size):
+        blocks.append('[[code type="python"]]\n')
+        blocks.extend('    x{} = "<tag>" & {} # comment\n'.format(n, n) for n in range(start, start + block_size))
+        blocks.append('[[/code]]\n\nA line of prose between blocks.\n\n')
+
+    return ''.join(blocks)
+
+
+def link_page(lines):
+    return ''.join(LINK_LINE.format(n=n) + '\n' for n in range(lines))
+
+
+def make_wikidot(image_prefix='', link_prefix='', link_suffix=''):
+    return wikidot_to_html.Wikidot(argparse.Namespace(image_prefix=image_prefix,
+                                                      link_prefix=link_prefix,
+                                                      link_suffix=link_suffix))
+
+
+def synthetic_page(sections, toc=False):
+    text = ''.join(SECTION.format(n=n) for n in range(sections))
+    if toc:
+        text = wikidot_to_html.TOC_LITERAL + '\n\n' + text
+
+    return text
+
+
+def render(text):
+    output_stream = io.StringIO()
+    make_wikidot().to_html(io.StringIO(text), output_stream)
+
+    return output_stream.getvalue()
+
+
+def best_of(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Measures how many tokens per second InlineParser.parse handles on the
+lines of the phrase, font and links fixtures.  The lines are lexed
+beforehand, so only the parser is timed.
+"""
+
+import os
+
+import common
+import wikidot_to_html
+
+FIXTURES = ['phrase', 'font', 'links']
+REPEAT = 200
+
+
+def fixture_tokens(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'input', name + '.wikidot')
+    with open(path) as f:
+        return [list(wikidot_to_html.token_lex(line.rstrip())) for line in f]
+
+
+def parse_all(wikidot, lines):
+    for _ in range(REPEAT):
+        for tokens in lines:
+            wikidot_to_html.InlineParser(wikidot).parse(tokens)
+
+
+def main():
+    wikidot = common.make_wikidot()
+    for name in FIXTURES:
+        lines = fixture_tokens(name)
+        token_cnt = REPEAT * sum(len(tokens) for tokens in lines)
+        elapsed = common.best_of(lambda: parse_all(wikidot, lines))  # pylint: disable=cell-var-from-loop
+        print('{:<8} {:>8} tokens  {:>10.0f} tokens/sec'.format(name, token_cnt, token_cnt / elapsed))
+
+
+if __name__ == '__main__':
+    main()
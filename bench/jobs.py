@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Measures how batch conversion scales with the number of worker
+processes, and checks that every worker count produces the same files.
+"""
+
+import argparse
+import os
+import tempfile
+
+import common
+import wikidot_to_html
+
+PAGES = 400
+SECTIONS_PER_PAGE = 10
+JOBS = [1, 2, 4, 8]
+
+
+def make_site(input_dir):
+    for n in range(PAGES):
+        subdir = os.path.join(input_dir, 'dir{}'.format(n % 10))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, 'page{}.wikidot'.format(n)), 'w') as f:
+            f.write(common.synthetic_page(SECTIONS_PER_PAGE, toc=(n % 2 == 0)))
+
+
+def tree_contents(root):
+    contents = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                contents[os.path.relpath(path, root)] = f.read()
+
+    return contents
+
+
+def main():
+    args = argparse.Namespace(image_prefix='', link_prefix='', link_suffix='')
+    with tempfile.TemporaryDirectory() as tmp:
+        input_dir = os.path.join(tmp, 'input')
+        make_site(input_dir)
+        serial_elapsed = None
+        serial_contents = None
+        for jobs in JOBS:
+            output_dir = os.path.join(tmp, 'output{}'.format(jobs))
+            page_cnt, _, elapsed = wikidot_to_html.convert_tree(args, input_dir, output_dir, jobs)
+            contents = tree_contents(output_dir)
+            if serial_elapsed is None:
+                serial_elapsed = elapsed
+                serial_contents = contents
+            identical = contents == serial_contents
+            print('jobs={}  {} pages  {:7.3f}s  {:7.1f} pages/sec  speedup {:.2f}x  identical={}'.format(
+                jobs, page_cnt, elapsed, page_cnt / elapsed, serial_elapsed / elapsed, identical))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Measures how many lines per second are classified by analyze_line, and
+rendered by Wikidot.to_html, on a large corpus mixing the synthetic
+page with the test fixtures and plain prose.
+"""
+
+import os
+
+import common
+import wikidot_to_html
+
+PROSE = '''This is an ordinary line of prose of the kind which makes up most pages.
+It has some punctuation, numbers like 1,234 and a sentence or two.
+
+'''
+REPEAT = 20
+
+
+def corpus():
+    input_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'input')
+    fixtures = []
+    for name in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, name), encoding='utf-8') as f:
+            fixtures.append(f.read().rstrip('\n') + '\n\n')
+
+    return (common.synthetic_page(20) + ''.join(fixtures) + PROSE * 200) * 10
+
+
+def classify(lines):
+    for _ in range(REPEAT):
+        for line in lines:
+            wikidot_to_html.analyze_line(line, None)
+
+
+def main():
+    text = corpus()
+    lines = [line.rstrip() for line in text.split('\n')]
+    elapsed = common.best_of(lambda: classify(lines)) / REPEAT
+    print('{:<14} {:>7} lines  {:>10.0f} lines/sec'.format('analyze_line', len(lines), len(lines) / elapsed))
+    elapsed = common.best_of(lambda: common.render(text))
+    print('{:<14} {:>7} lines  {:>10.0f} lines/sec'.format('to_html', len(lines), len(lines) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Measures how many list items per second are rendered for long lists,
+such as changelog pages, flat and nested, with and without inline
+markup, and with markup left open in the first item, which is carried
+over every item after it.
+"""
+
+import common
+
+ITEMS = 5000
+
+
+def cases():
+    yield 'flat', ''.join('* Fixed issue {} in the parser\n'.format(n) for n in range(ITEMS))
+    yield 'markup', ''.join('* **Fixed** issue [http://example.com/{0} #{0}] in //the parser//\n'.format(n)
+                            for n in range(ITEMS))
+    yield 'nested', ''.join(' ' * (n % 4) + '# step {} with __underline__\n'.format(n) for n in range(ITEMS))
+    yield 'open', '* **unclosed [[span class="a"]]bold\n' + ''.join('* Fixed issue {}\n'.format(n) for n in range(ITEMS - 1))
+
+
+def main():
+    for name, text in cases():
+        elapsed = common.best_of(lambda: common.render(text))  # pylint: disable=cell-var-from-loop
+        print('{:<8} {:>6} items  {:>9.0f} items/sec'.format(name, ITEMS, ITEMS / elapsed))
+
+
+if __name__ == '__main__':
+    main()
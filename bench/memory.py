@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Measures with tracemalloc the memory held by the inline trees of a
+large synthetic page, the peak memory of rendering the page, and the
+peak memory of rendering a long table to a stream which drops its
+output, which stays flat however many rows the table has.
+"""
+
+import gc
+import tracemalloc
+
+import common
+import wikidot_to_html
+
+SECTIONS = 2000
+TABLE_ROWS = 20000
+
+
+def inline_trees(lines):
+    wikidot = common.make_wikidot()
+    trees = []
+    for line in lines:
+        parser = wikidot_to_html.InlineParser(wikidot)
+        parser.parse_line(line)
+        trees.append(parser.top_node)
+
+    return trees
+
+
+def walk(node):
+    yield node
+    for child in getattr(node, 'children', ()):
+        yield from walk(child)
+
+
+def main():
+    text = common.synthetic_page(SECTIONS)
+    lines = [line for line in text.split('\n') if line and not line.startswith('[[') and not line.startswith(' ')]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    trees = inline_trees(lines)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    item_cnt = sum(1 for tree in trees for _ in walk(tree))
+    del trees
+    gc.collect()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    common.render(text)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    table_lines = common.wide_table_page(TABLE_ROWS, columns=10).splitlines()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    common.make_wikidot().to_html(iter(table_lines), wikidot_to_html.NullOutputStream())
+    table_peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    print('inline trees  {:>8} lines  {:>8} items  {:>7.1f} MB held  {:>5.0f} bytes/item'.format(
+        len(lines), item_cnt, held / 1e6, held / item_cnt))
+    print('render        {:>8} chars  {:>7.1f} MB peak'.format(len(text), peak / 1e6))
+    print('table         {:>8} rows   {:>7.1f} MB peak'.format(TABLE_ROWS, table_peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
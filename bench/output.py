@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Compares writing every small piece of output straight to a text file,
+as with --output-buffer-size 0, against gathering the pieces and
+writing them in chunks of the given sizes, for large tables and lists.
+The write path alone is timed by replaying the pieces a page was
+rendered as, and the whole conversion is timed too.
+"""
+
+import io
+import os
+import tempfile
+
+import common
+import wikidot_to_html
+
+BUFFER_SIZES = [0, 4 * 1024, 64 * 1024, 1024 * 1024]
+PAGES = [
+    ('wide-table', lambda: common.wide_table_page(2000, columns=10)),
+    ('deep-list', lambda: common.deep_list_page(20000)),
+]
+REPEAT = 5
+
+
+class RecordingStream:
+    def __init__(self):
+        self.pieces = []
+        self.write = self.pieces.append
+
+
+def replay(pieces, output_path, buffer_size):
+    with open(output_path, 'w', encoding='utf-8') as output_stream:
+        segmented_stream = wikidot_to_html.SegmentedOutputStream(output_stream, buffer_size=buffer_size)
+        for piece in pieces:
+            segmented_stream.write(piece)
+        segmented_stream.flush()
+
+
+def convert(text, output_path, buffer_size):
+    wikidot = common.make_wikidot()
+    wikidot.output_buffer_size = buffer_size
+    with open(output_path, 'w', encoding='utf-8') as output_stream:
+        wikidot.to_html(io.StringIO(text), output_stream)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, 'page.html')
+        for name, page in PAGES:
+            text = page()
+            recording_stream = RecordingStream()
+            wikidot = common.make_wikidot()
+            wikidot.output_buffer_size = 0
+            wikidot.to_html(io.StringIO(text), recording_stream)
+            pieces = recording_stream.pieces
+            baseline = None
+            for buffer_size in BUFFER_SIZES:
+                # pylint: disable=cell-var-from-loop
+                write_time = common.best_of(lambda: replay(pieces, output_path, buffer_size), REPEAT)
+                convert_time = common.best_of(lambda: convert(text, output_path, buffer_size), REPEAT)
+                if baseline is None:
+                    baseline = write_time, convert_time
+                print('{:<12} {:>6} pieces  buffer {:>8}  write {:7.4f}s  {:5.2f}x  convert {:7.3f}s  {:5.2f}x'.format(
+                    name, len(pieces), buffer_size, write_time, baseline[0] / write_time,
+                    convert_time, baseline[1] / convert_time))
+
+
+if __name__ == '__main__':
+    main()
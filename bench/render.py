@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Measures rendering of parsed inline trees to HTML: str() of the top
+node of a paragraph, which is where nested markup used to copy the
+same text once per level of nesting.
+"""
+
+import common
+import wikidot_to_html
+
+NESTED_RUN = '**//__--text--__//**'
+SPAN_OPEN = '[[span class="a"]]'
+SPAN_CLOSE = '[[/span]]'
+REPEAT = 5
+
+
+def parse(lines):
+    parser = wikidot_to_html.InlineParser(common.make_wikidot())
+    for line in lines:
+        parser.parse(wikidot_to_html.token_lex(line))
+
+    return parser.top_node
+
+
+def cases():
+    yield 'nested runs', [' '.join([NESTED_RUN] * 2000)]
+    yield 'nested spans', [SPAN_OPEN * 300 + ' '.join(['word'] * 20000) + SPAN_CLOSE * 300]
+    yield 'long paragraph', ['Some //italic// and **bold** text with a [http://example.com link] in it.'] * 2000
+
+
+def render(top_node):
+    for _ in range(REPEAT):
+        str(top_node)
+
+
+def main():
+    for name, lines in cases():
+        top_node = parse(lines)
+        size = len(str(top_node))
+        elapsed = common.best_of(lambda: render(top_node)) / REPEAT  # pylint: disable=cell-var-from-loop
+        print('{:<15} {:>9} chars  {:8.2f} ms  {:7.1f} MB/sec'.format(
+            name, size, elapsed * 1000, size / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
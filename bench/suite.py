@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput of each stage of the converter on synthetic
+pages of long prose, wide tables, deep lists, code and links:
+
+    str_lex      lexing each line into strings
+    token_lex    lexing each line into typed tokens
+    inline       InlineParser.parse on the lexed lines
+    block        classifying each line with analyze_line
+    pipeline     Wikidot.to_html on the whole page
+
+Results can be saved as JSON and compared with a saved run; a stage
+which is slower than in the saved run by more than the threshold is
+reported as a regression and the exit status is 1:
+
+    python3 bench/suite.py --save before.json
+    python3 bench/suite.py --compare before.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+
+import common
+import wikidot_to_html
+
+PAGES = [
+    ('prose', lambda: common.prose_page(1000)),
+    ('wide-table', lambda: common.wide_table_page(80)),
+    ('deep-list', lambda: common.deep_list_page(1000)),
+    ('code', lambda: common.code_page(2000)),
+    ('code-listing', lambda: common.code_page(5000, block_size=5000)),
+    ('links', lambda: common.link_page(500)),
+]
+DEFAULT_THRESHOLD = 10.0
+
+
+def lex_lines(lex, lines):
+    for line in lines:
+        for _ in lex(line):
+            pass
+
+
+def parse_lines(wikidot, token_lines):
+    for tokens in token_lines:
+        wikidot_to_html.InlineParser(wikidot).parse(tokens)
+
+
+def classify_lines(lines):
+    for line in lines:
+        wikidot_to_html.analyze_line(line, None)
+
+
+def stages(text):
+    lines = wikidot_to_html.split_lines(text)
+    token_lines = [list(wikidot_to_html.token_lex(line)) for line in lines]
+    wikidot = common.make_wikidot()
+    yield 'str_lex', lambda: lex_lines(wikidot_to_html.str_lex, lines)
+    yield 'token_lex', lambda: lex_lines(wikidot_to_html.token_lex, lines)
+    yield 'inline', lambda: parse_lines(wikidot, token_lines)
+    yield 'block', lambda: classify_lines(lines)
+    yield 'pipeline', lambda: common.render(text)
+
+
+def run(repeat):
+    """
+    The stages are run in turn, *repeat* times over, and the best time
+    of each is kept, so that a slow spell on the machine does not
+    single out one stage.
+    """
+    cases = []
+    for page, generate in PAGES:
+        text = generate()
+        line_cnt = len(wikidot_to_html.split_lines(text))
+        for stage, func in stages(text):
+            cases.append(('{}/{}'.format(page, stage), func, line_cnt, len(text)))
+
+    best = {}
+    for _ in range(repeat):
+        for name, func, _, _ in cases:
+            elapsed = common.best_of(func, 1)
+            best[name] = min(elapsed, best.get(name, elapsed))
+
+    return {name: {'seconds': best[name],
+                   'lines_per_sec': line_cnt / best[name],
+                   'mb_per_sec': size / best[name] / 1e6}
+            for name, _, line_cnt, size in cases}
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the names of the stages whose throughput fell by more than
+    *threshold* percent.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = 100.0 * (result['lines_per_sec'] / baseline[name]['lines_per_sec'] - 1)
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<22} {:>12.0f} -> {:>12.0f} lines/sec  {:+7.1f}%{}'.format(
+            name, baseline[name]['lines_per_sec'], result['lines_per_sec'], change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved by --save')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='percent slowdown reported as a regression (default {})'.format(DEFAULT_THRESHOLD))
+    parser.add_argument('--repeat', type=int, default=7, help='runs of each stage; the best is kept')
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    else:
+        for name, result in results.items():
+            print('{:<22} {:>12.0f} lines/sec  {:>8.2f} MB/sec'.format(name, result['lines_per_sec'], result['mb_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Compares single-pass rendering against the old two-pass strategy, in
+which every page was rendered once into a NullOutputStream to collect
+the headers for [[toc]] and then rendered again for real.
+"""
+
+import io
+
+import common
+import wikidot_to_html
+
+
+def two_pass(text):
+    common.make_wikidot().to_html(io.StringIO(text), wikidot_to_html.NullOutputStream())
+    common.render(text)
+
+
+def main():
+    for sections in [100, 500, 2000]:
+        for toc in [False, True]:
+            text = common.synthetic_page(sections, toc=toc)
+            before = common.best_of(lambda: two_pass(text))  # pylint: disable=cell-var-from-loop
+            after = common.best_of(lambda: common.render(text))  # pylint: disable=cell-var-from-loop
+            print('{:>5} sections, toc={!s:<5}  two-pass {:7.3f}s  single-pass {:7.3f}s  speedup {:.2f}x'.format(
+                sections, toc, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,16 @@ output stream.
     literal: @@
     html entity literal: @< >@
 
+## Library Use
+
+    import wikidot_to_html
+
+    html = wikidot_to_html.render(text, link_prefix='/wiki')
+
+*render* accepts str or UTF-8 bytes.  A *Renderer* keeps its options
+between calls and may be shared by threads.  An *IncrementalDocument*
+re-renders only the blocks around an edited range of lines.
+
 ## Architecture
 
 The *BlockParser* iterates through input by line and assigns each line
@@ -42,7 +52,16 @@ to an object of type *Block*.  If a *Block* object has inline content,
 *lex* is used to tokenize the content and *InlineParser* is used to
 convert the token stream to a tree of *Node* and *Text* objects.
 *Block*s are rendered by calling the *close* method.  *Node*s and
-*Text* are rendered by calling the *__str__* method.
+*Text* are rendered by calling the *render* method, which appends the
+HTML fragments of the whole tree to one list; *__str__* joins them.
+
+Input is read a line at a time and each *Block* is written to the
+output stream as soon as it closes.  The *TOC* cannot be rendered until
+all the headers are known, so the output after the first [[toc]] is
+held back by a *SegmentedOutputStream*, spilling to disk if it is large.
+With --input FILE the file is memory-mapped and *mapped_lines* decodes
+it a chunk of whole lines at a time, so a file larger than memory can
+be converted.
 
 ## Debugging
 
@@ -61,13 +80,13 @@ convert the token stream to a tree of *Node* and *Text* objects.
     problem.
 
     To find out how the lexer is splitting the input into tokens, use
-    PP.print(tokens) before str_lex() or token_lex() returns.
+    PP.pprint(list(str_lex(text))) or PP.pprint(list(token_lex(text))).
 
-    In InlineParser.parse(), use debug statements to figure out which
-    clause is getting triggered for each token.
+    In InlineParser.parse_tokens(), use debug statements to figure out
+    which parse_* handler is getting called for each token.
 
     If a Node object is rendered incorrectly, inspect the attributes
-    of the object when it renders in __str__().
+    of the object when it renders in render().
 
     Put debug statements in Block subclass constructors or
     BlockParser.add_line() to diagnose problems with how Block objects
@@ -76,7 +95,11 @@ convert the token stream to a tree of *Node* and *Text* objects.
 
     Put debug statements in Block.close() or the close() method of
     derived classes to inspect self.lines or self.matches if the Block
-    object is not rendered correctly.
+    object is not rendered correctly.  A Table writes its rows in
+    Table.write_rows() as the lines are read and then forgets them.
+
+    If a page is slow, --profile writes the time spent on each stage,
+    block type and range of lines to stderr as JSON.
 
 ## Design Defects
 
@@ -87,10 +110,29 @@ convert the token stream to a tree of *Node* and *Text* objects.
 """
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
 import html
+import http.server
+import io
+import itertools
+import json
+import math
+import mmap
+import os
 import pprint
 import re
+import shutil
+import signal
+import socketserver
 import sys
+import tempfile
+import threading
+import time
 # import traceback
 
 PP = pprint.PrettyPrinter(stream=sys.stderr)
@@ -123,6 +165,21 @@ MULTILINE_BLOCK_TYPES = [BLOCK_TYPE_CODE,
 
 TOC_LITERAL = '[[toc]]'
 
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+CACHE_MAX_SIZE = 512 * 1024 * 1024
+CACHE_CHUNK_SIZE = 64 * 1024
+SERVE_THREADS = 8
+LATENCY_SAMPLES = 10000
+PROFILE_LINE_RANGE = 100
+MAX_LINE_LENGTH = 100000
+MAX_LINE_TOKENS = 20000
+MAX_NESTING_DEPTH = 100
+PROFILE_SLOWEST_BLOCKS = 10
+OUTPUT_BUFFER_SIZE = 64 * 1024
+MMAP_CHUNK_SIZE = 1024 * 1024
+
+RX_CACHE_DIR = re.compile(r'^[0-9a-f]{2}$')
+RX_CACHE_FILE = re.compile(r'^(?P<key>[0-9a-f]{64})\.html$|^tmp\w+\.tmp$')
 RX_FULL_URL = re.compile(r'^(?P<scheme>[a-z]+):(?P<rest>.*)$')
 RX_BLOCKQUOTE = re.compile(
     r'^(?P<greater_than_signs>>+)\s*(?P<content>.*?)(?P<br> _)?$')
@@ -130,17 +187,14 @@ RX_CODE_START = re.compile(
     r'^(?P<indent>\s*)(?P<raw_tag>\[\[code(\s+type="(?P<type>.*?)"\s*)?\]\])'
     r'(?P<content>.*)$')
 RX_CODE_END = re.compile(r'^\[\[/code\]\]$')
-RX_CODE_CONTENT = re.compile(r'^(?P<content>.*?)$')
 RX_HTML_START = re.compile(
     r'^(?P<indent>\s*)(?P<raw_tag>\[\[html\]\])'
     r'(?P<content>.*)$')
 RX_HTML_END = re.compile(r'^\[\[/html\]\]$')
-RX_HTML_CONTENT = re.compile(r'^(?P<content>.*?)$')
 RX_MATH_START = re.compile(
     r'^(?P<indent>\s*)(?P<raw_tag>\[\[math\]\])'
     r'(?P<content>.*)$')
 RX_MATH_END = re.compile(r'^\[\[/math\]\]$')
-RX_MATH_CONTENT = re.compile(r'^(?P<content>.*?)$')
 RX_DIV_START = re.compile(
     r'^(?P<indent>\s*)(?P<raw_tag>\[\[div(?P<attributes>.*)\]\])$')
 RX_DIV_ATTR = re.compile(r'^\s*(?P<name>[a-z0-9-]+)="(?P<value>.*?)"'
@@ -172,22 +226,18 @@ RX_PARSE_TRIPLE_BRACKET = re.compile(
     r'^\[\[\[(?P<href>[^|]*)(\|(?P<name>.+))?\]\]\]$')
 RX_PARSE_DOUBLE_BRACKET = re.compile(r'^\[\[#\s+(?P<anchor>.+)\]\]$')
 RX_PARSE_SINGLE_BRACKET = re.compile(r'^\[(?P<href>\S+)\s+(?P<name>.+)\]$')
-RX_TRIPLE_BRACKET = re.compile(
-    r'(?P<token>^\[\[\[[^\]|]+(\|[^\]|]+)?\]\]\])(?P<text>.*)$')
-RX_DOUBLE_BRACKET = re.compile(
-    r'^(?P<token>\[\[[^\]]+\]\])(?P<text>.*)$')
-RX_SINGLE_BRACKET = re.compile(
-    r'^(?P<token>\[(?P<head>[^\]\s]+)[^\]]*\])(?P<text>.*)$')
-RX_ESCAPE_CHAR = re.compile(r'@|<|>')
-RX_DOUBLED_CHAR = re.compile(
-    r'^(//|\*\*|\{\{|\}\}|--|__|,,|\^\^|\|\|)')
-RX_COLOR_HEAD = re.compile(r'^(?P<token>##[a-zA-Z][a-zA-Z0-9 ]*\|)'
-                           '(?P<text>.*)$')
-RX_LEAD_WHITESPACE = re.compile(r'^(?P<token>\s+)(?P<text>.*)$')
+RX_TRIPLE_BRACKET = re.compile(r'\[\[\[[^\]|]+(\|[^\]|]+)?\]\]\]')
+RX_DOUBLE_BRACKET = re.compile(r'\[\[[^\]]+\]\]')
+RX_SINGLE_BRACKET = re.compile(r'\[(?P<head>[^\]\s]+)(\s[^\]]*)?\]')
+RX_DOUBLED_CHAR = re.compile(r'//|\*\*|\{\{|\}\}|--|__|,,|\^\^|\|\|')
+RX_COLOR_HEAD = re.compile(r'##[a-zA-Z][a-zA-Z0-9 ]*\|')
+RX_LEX_SPECIAL = re.compile(r'\[|##|\s|//|\*\*|\{\{|\}\}|--|__|,,|\^\^|\|\||https?://')
 RX_URL_FRAGMENT = re.compile(r'^#[a-zA-Z0-9][a-zA-Z0-9-_]*$')
+RX_URL_FRAGMENT_HEAD = re.compile(r'#[a-zA-Z0-9][a-zA-Z0-9-_]*')
 RX_URL = re.compile(
     r'^(?P<token>https?://[a-zA-Z0-9-._~:/#&?=+,;]*[a-zA-Z0-9-_~/#&?=+])'
     r'(?P<text>.*)$')
+RX_URL_TOKEN = re.compile(r'https?://[a-zA-Z0-9-._~:/#&?=+,;]*[a-zA-Z0-9-_~/#&?=+]')
 RX_IMAGE = re.compile(r'^\[\[(?P<alignment>=?)image\s+(?P<src>\S+)\s*(?P<attrs>.*)\]\]$')
 RX_IMAGE_ATTR = re.compile(
     r'^\s*(?P<attr>[^ =]+)'
@@ -203,13 +253,95 @@ RX_EMPTY_PARAGRAPH = re.compile(r'^(<br />|\s)*$', re.M)
 RX_BLANK_LINE = re.compile(r'^\s*$')
 RX_TABLE_CELL_LEXER = re.compile(r'(\|\||@|<|>)')
 
+# The block regex, if any, which can match a line, keyed by the first
+# character of the line which is not whitespace.  Anything else is a
+# paragraph.
+LINE_TYPE_CANDIDATES = {
+    '*': (BLOCK_TYPE_UL, RX_UL),
+    '#': (BLOCK_TYPE_OL, RX_OL),
+    '+': (BLOCK_TYPE_HN, RX_HN),
+    '-': (BLOCK_TYPE_HR, RX_HR),
+    '|': (BLOCK_TYPE_TABLE, RX_TABLE),
+    '': (BLOCK_TYPE_EMPTY, RX_EMPTY),
+    '_': (BLOCK_TYPE_EMPTY, RX_EMPTY),
+}
+
 
 class NullOutputStream:
     def write(self, s):
         pass
 
 
+class SegmentedOutputStream:
+    """
+    Gathers the many small writes of the blocks and passes them on to the
+    output stream joined, once they reach *buffer_size* characters,
+    until a placeholder, such as the table of contents, is written.  A
+    placeholder is any object with a close(output_stream) method; it
+    cannot be rendered until the end of the document, so the output
+    after it is held back in temporary files which spill to disk once
+    they exceed *max_size* bytes.
+    """
+    def __init__(self, output_stream, max_size=SPOOL_MAX_SIZE, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.output_stream = output_stream
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self.segments = []
+        self.spool = None
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, s):
+        self.pending.append(s)
+        self.pending_size += len(s)
+        if self.pending_size >= self.buffer_size:
+            self.write_pending()
+
+    def write_pending(self):
+        if not self.pending:
+            return
+        if not self.segments:
+            self.output_stream.write(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+            return
+        if self.spool is None:
+            self.spool = tempfile.SpooledTemporaryFile(max_size=self.max_size,
+                                                       mode='w+',
+                                                       encoding='utf-8',
+                                                       errors='surrogatepass')
+            self.segments.append(self.spool)
+        self.spool.write(''.join(self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+    def write_placeholder(self, placeholder):
+        self.write_pending()
+        self.spool = None
+        self.segments.append(placeholder)
+
+    def flush(self):
+        self.write_pending()
+        for segment in self.segments:
+            if isinstance(segment, tempfile.SpooledTemporaryFile):
+                segment.seek(0)
+                shutil.copyfileobj(segment, self.output_stream)
+                segment.close()
+            else:
+                segment.close(self.output_stream)
+        self.segments = []
+        self.spool = None
+
+
 class ClosureNode:
+    """
+    Whether a node's markup was closed.  A node reopened to carry its
+    markup onto the next line or past a closed node shares the closure
+    of the node it continues, so closing the markup closes them all at
+    once.
+    """
+    __slots__ = ('is_closed',)
+
     def __init__(self, is_closed):
         self.is_closed = is_closed
 
@@ -222,158 +354,218 @@ CLOSED_NODE = ClosureNode(True)
 
 
 class Node:
-    def __init__(self, wikidot, raw_tag='', open_tag='', close_tag=None):
-        self.wikidot = wikidot
+    """
+    A node of the inline tree.  The tags of most node types are class
+    constants, so an instance holds only its children and closure.
+    """
+    __slots__ = ('children', 'closure')
+    raw_tag = ''
+    open_tag = ''
+    close_tag = ''
+
+    def __init__(self, wikidot=None):
         self.children = []
-        self.raw_tag = raw_tag
-        self.open_tag = open_tag
-        self.close_tag = open_tag if close_tag is None else close_tag
         self.closure = OPEN_NODE
 
-    def set_closure(self, nd=True):
-        self.closure = nd
+    def mark_closed(self):
+        if self.closure is OPEN_NODE:
+            self.closure = CLOSED_NODE
+        else:
+            self.closure.is_closed = True
+
+    def reopen(self):
+        """
+        Returns an empty node of the same kind, which continues this one
+        and shares its closure.
+        """
+        if self.closure is OPEN_NODE:
+            self.closure = ClosureNode(False)
+        nd = self.empty_copy()
+        nd.closure = self.closure
+
+        return nd
+
+    def empty_copy(self):
+        return type(self)()
 
     def closed(self):
         return self.closure.closed()
 
     def __str__(self):
-        if not self.children:
-            first = ''
-            rest = ''
-        elif len(self.children) == 1:
-            if self.children[0] == ' ':
-                first = ' '
-                rest = ''
+        out = []
+        self.render(out)
+        return ''.join(out)
+
+    def render_children(self, out, children, start=0):
+        append = out.append
+        for child in itertools.islice(children, start, None) if start else children:
+            if child.__class__ is str:
+                if child:
+                    append(child)
             else:
-                first = ''
-                rest = str(self.children[0])
-        else:
-            if self.children[0] == ' ':
-                first = ' '
-                rest = ''.join([str(child) for child in self.children[1:]])
+                child.render(out)
+
+    def render(self, out):
+        """
+        Appends the HTML for the node to the list *out*.  Empty strings
+        are never appended, so a node can tell whether its children
+        rendered anything from the length of *out*.
+        """
+        children = self.children
+        first = 0
+        if children and children[0] == ' ':
+            out.append(' ')
+            first = 1
+
+        if self.closure.closed():
+            start = len(out)
+            out.append('<')
+            self.render_children(out, children, first)
+            if len(out) > start + 1:
+                out[start] = '<' + self.open_tag + '>'
+                out.append('</' + self.close_tag + '>')
             else:
-                first = ''
-                rest = ''.join([str(child) for child in self.children])
-
-        if self.closed():
-            if rest:
-                return '{}<{}>{}</{}>'.format(first,
-                                              self.open_tag,
-                                              rest,
-                                              self.close_tag)
-            return first
-        return '{}{}{}{}'.format(first, self.raw_tag, rest, '')
+                del out[start:]
+        else:
+            if self.raw_tag:
+                out.append(self.raw_tag)
+            self.render_children(out, children, first)
 
 
 class Italic(Node):
-    def __init__(self, wikidot, raw_tag='//'):
-        Node.__init__(self, wikidot, raw_tag, 'em')
+    __slots__ = ()
+    raw_tag = '//'
+    open_tag = close_tag = 'em'
 
 
 class Bold(Node):
-    def __init__(self, wikidot, raw_tag='**'):
-        Node.__init__(self, wikidot, raw_tag, 'strong')
+    __slots__ = ()
+    raw_tag = '**'
+    open_tag = close_tag = 'strong'
 
 
 class FixedWidth(Node):
-    def __init__(self, wikidot, raw_tag='{{'):
-        Node.__init__(self, wikidot, raw_tag, 'tt')
+    __slots__ = ()
+    raw_tag = '{{'
+    open_tag = close_tag = 'tt'
 
 
 class StrikeThru(Node):
-    def __init__(self, wikidot, raw_tag='--'):
-        Node.__init__(self,
-                      wikidot,
-                      raw_tag,
-                      'span style="text-decoration: line-through;"',
-                      'span')
+    __slots__ = ()
+    raw_tag = '--'
+    open_tag = 'span style="text-decoration: line-through;"'
+    close_tag = 'span'
 
 
 class Underline(Node):
-    def __init__(self, wikidot, raw_tag='__'):
-        Node.__init__(self,
-                      wikidot,
-                      raw_tag,
-                      'span style="text-decoration: underline;"',
-                      'span')
+    __slots__ = ()
+    raw_tag = '__'
+    open_tag = 'span style="text-decoration: underline;"'
+    close_tag = 'span'
 
 
 class Subscript(Node):
-    def __init__(self, wikidot, raw_tag=',,'):
-        Node.__init__(self, wikidot, raw_tag, 'sub')
+    __slots__ = ()
+    raw_tag = ',,'
+    open_tag = close_tag = 'sub'
 
 
 class Superscript(Node):
-    def __init__(self, wikidot, raw_tag='^^'):
-        Node.__init__(self, wikidot, raw_tag, 'sup')
+    __slots__ = ()
+    raw_tag = '^^'
+    open_tag = close_tag = 'sup'
 
 
-class Span(Node):
+class TaggedNode(Node):
+    """
+    A node whose raw tag and open tag come from the markup.
+    """
+    __slots__ = ('raw_tag', 'open_tag')
+    close_tag = 'span'
+
     def __init__(self, wikidot, raw_tag, tag):
-        Node.__init__(self, wikidot, raw_tag, tag, 'span')
+        Node.__init__(self, wikidot)
+        self.raw_tag = raw_tag
+        self.open_tag = tag
 
-    def __str__(self):
-        return '{}{}{}'.format(
-            '<{}>'.format(self.open_tag),
-            ''.join([str(child) for child in self.children]).rstrip(),
-            '</span>')
+    def empty_copy(self):
+        return type(self)(None, self.raw_tag, self.open_tag)
 
 
-class Color(Node):
-    def __init__(self, wikidot, raw_tag, tag):
-        Node.__init__(self, wikidot, raw_tag, tag, 'span')
+class Span(TaggedNode):
+    __slots__ = ()
 
+    def render(self, out):
+        out.append('<{}>'.format(self.open_tag))
+        start = len(out)
+        self.render_children(out, self.children)
+        while len(out) > start and not out[-1].rstrip():
+            out.pop()
+        if len(out) > start:
+            out[-1] = out[-1].rstrip()
+        out.append('</span>')
 
-class Size(Node):
-    def __init__(self, wikidot, raw_tag, tag):
-        Node.__init__(self, wikidot, raw_tag, tag, 'span')
 
+class Color(TaggedNode):
+    __slots__ = ()
 
-class Literal(Node):
-    def __init__(self, wikidot, raw_tag, tag):
-        Node.__init__(self, wikidot, raw_tag, tag, 'span')
 
-    def __str__(self):
-        s = ''.join([str(child) for child in self.children])
-        s = RX_SPACE.sub('&#32;', s)
-        return '<{}>{}</{}>'.format(self.open_tag,
-                                    s,
-                                    self.close_tag)
+class Size(TaggedNode):
+    __slots__ = ()
 
 
-class HTMLEntityLiteral(Node):
-    def __init__(self, wikidot, raw_tag, tag):
-        Node.__init__(self, wikidot, raw_tag, tag, 'span')
+class Literal(TaggedNode):
+    __slots__ = ()
 
-    def __str__(self):
-        s = ''.join([str(child) for child in self.children])
-        s = RX_SPACE.sub('&#32;', s)
-        return '<{}>{}</{}>'.format(self.open_tag,
-                                    s,
-                                    self.close_tag)
+    def render(self, out):
+        out.append('<{}>'.format(self.open_tag))
+        start = len(out)
+        self.render_children(out, self.children)
+        for i in range(start, len(out)):
+            out[i] = RX_SPACE.sub('&#32;', out[i])
+        out.append('</{}>'.format(self.close_tag))
+
+
+class HTMLEntityLiteral(TaggedNode):
+    __slots__ = ()
+
+    def render(self, out):
+        out.append('<{}>'.format(self.open_tag))
+        start = len(out)
+        self.render_children(out, self.children)
+        for i in range(start, len(out)):
+            out[i] = RX_SPACE.sub('&#32;', out[i])
+        out.append('</{}>'.format(self.close_tag))
 
 
 class Text:
-    def __init__(self, wikidot, raw_tag='', open_tag='', close_tag=None):
-        self.wikidot = wikidot
+    __slots__ = ('raw_tag',)
+
+    def __init__(self, wikidot, raw_tag=''):
         self.raw_tag = raw_tag
-        self.open_tag = open_tag
-        self.close_tag = open_tag if close_tag is None else close_tag
 
     def __str__(self):
         return self.raw_tag
 
+    def render(self, out):
+        s = str(self)
+        if s:
+            out.append(s)
+
 
 class Link(Text):
+    __slots__ = ('open_tag', 'content')
+    close_tag = 'a'
+
     def __init__(self, wikidot, raw_tag, href, content):
-        self.wikidot = wikidot
+        Text.__init__(self, wikidot, raw_tag)
         full_href = href
         match = RX_FULL_URL.search(href)
         if not match and not href.startswith('#'):
-            full_href = '{}/{}{}'.format(self.wikidot.link_prefix.rstrip('/'),
+            full_href = '{}/{}{}'.format(wikidot.link_prefix.rstrip('/'),
                                          href.lstrip('/'),
-                                         self.wikidot.link_suffix)
-        Text.__init__(self, wikidot, raw_tag, 'a href="{}"'.format(full_href), 'a')
+                                         wikidot.link_suffix)
+        self.open_tag = 'a href="{}"'.format(full_href)
         self.content = content
 
     def __str__(self):
@@ -383,22 +575,25 @@ class Link(Text):
 
 
 class Anchor(Text):
+    __slots__ = ('open_tag',)
+    close_tag = 'a'
+
     def __init__(self, wikidot, raw_tag, name):
-        Text.__init__(self, wikidot, raw_tag, 'a name="{}"'.format(name), 'a')
+        Text.__init__(self, wikidot, raw_tag)
+        self.open_tag = 'a name="{}"'.format(name)
 
     def __str__(self):
         return '<{}></{}>'.format(self.open_tag, self.close_tag)
 
 
 class Image(Text):
+    __slots__ = ('wikidot', 'src', 'attrs', 'alignemnt')
     ATTRS = ['title', 'width', 'height', 'style', 'class', 'size']
+    open_tag = close_tag = 'img'
 
     def __init__(self, wikidot, raw_tag, src, attrs, alignment):
+        Text.__init__(self, wikidot, raw_tag)
         self.wikidot = wikidot
-        Text.__init__(self,
-                      wikidot,
-                      raw_tag,
-                      'img')
         self.src = src
         self.attrs = attrs
         self.alignemnt = alignment
@@ -424,123 +619,130 @@ class Image(Text):
 
 
 class LineBreak(Node):
-    def __init__(self, wikidot):
-        Node.__init__(self, wikidot)
+    __slots__ = ()
+
+    def render(self, out):
+        out.append('<br />\n')
 
-    def __str__(self):
-        return '<br />\n'
+
+# The markers str_lex generates, so that each occurrence is the same
+# string object rather than a new slice of the line.
+MARKER_TOKENS = {token: token for token in ['//', '**', '{{', '}}', '--', '__', ',,', '^^', '||',
+                                            '[[/span]]', '[[/size]]']}
 
 
 def str_lex(text):
-    tokens = []
-    prefix_and_text = text
-    prefix = ''
-    text_i = 0
-    while text:
-        if text.startswith('['):
-            if text.startswith('[!--'):
-                tokens.append('[!--')
-                prefix_and_text = text[4:]
-                text = prefix_and_text
-                text_i = 0
-                continue
-            md = RX_TRIPLE_BRACKET.search(text)
-            if md:
-                if prefix:
-                    tokens.append(prefix)
-                    prefix = ''
-                tokens.append(md.group('token'))
-                prefix_and_text = md.group('text')
-                text = prefix_and_text
-                text_i = 0
-                continue
-            md = RX_DOUBLE_BRACKET.search(text)
-            if md:
-                if prefix:
-                    tokens.append(prefix)
-                    prefix = ''
-                tokens.append(md.group('token'))
-                prefix_and_text = md.group('text')
-                text = prefix_and_text
-                text_i = 0
+    """
+    Generates the string tokens of inline content in a single scan.
+
+    Runs of plain text are skipped with RX_LEX_SPECIAL.  Note that every
+    character before the last @, < or > becomes a token of its own, and
+    that [!--, --] and bare URLs do not flush the pending prefix.
+
+    The bracket regexes are only tried where they can match, given the
+    next ], so that a long run of [ does not make the scan quadratic.
+    """
+    end = len(text)
+    last_escape = max(text.rfind('@'), text.rfind('<'), text.rfind('>'))
+    close = -1
+    pos = 0
+    prefix_start = 0
+    pending_start = pending_end = 0
+    while pos < end:
+        char = text[pos]
+        if char == '[':
+            if text.startswith('[!--', pos):
+                yield '[!--'
+                pos += 4
+                prefix_start = pos
                 continue
-            md = RX_SINGLE_BRACKET.search(text)
-            if md:
-                head = md.group('head')
-                if RX_URL.search(head) or RX_URL_FRAGMENT.search(head):
-                    if prefix:
-                        tokens.append(prefix)
-                        prefix = ''
-                    tokens.append(md.group('token'))
-                    prefix_and_text = md.group('text')
-                    text = prefix_and_text
-                    text_i = 0
-                    continue
-        if text.startswith('##'):
-            if prefix:
-                tokens.append(prefix)
-                prefix = ''
-            md = RX_COLOR_HEAD.search(text)
+            if close < pos:
+                close = text.find(']', pos)
+                if close < 0:
+                    close = end
+            md = None
+            if close < end:
+                if text.startswith(']]', close):
+                    md = RX_TRIPLE_BRACKET.match(text, pos) or RX_DOUBLE_BRACKET.match(text, pos)
+                if not md and bracket_head_is_link(text, pos + 1):
+                    md = RX_SINGLE_BRACKET.match(text, pos)
             if md:
-                tokens.append(md.group('token'))
-                prefix_and_text = md.group('text')
-                text = prefix_and_text
-                text_i = 0
+                if pending_end > pending_start:
+                    yield text[pending_start:pending_end]
+                    pending_start = pending_end
+                token = md.group()
+                yield MARKER_TOKENS.get(token, token)
+                pos = md.end()
+                prefix_start = pos
                 continue
-            tokens.append(text[0:2])
-            prefix_and_text = text[2:]
-            text = prefix_and_text
-            text_i = 0
+        elif text.startswith('##', pos):
+            if pending_end > pending_start:
+                yield text[pending_start:pending_end]
+                pending_start = pending_end
+            md = RX_COLOR_HEAD.match(text, pos)
+            token = md.group() if md else '##'
+            yield token
+            pos += len(token)
+            prefix_start = pos
             continue
-        md = RX_LEAD_WHITESPACE.search(text)
+        md = RX_WHITESPACE.match(text, pos)
         if md:
-            if prefix:
-                tokens.append(prefix)
-                prefix = ''
-            tokens.append(md.group('token'))
-            prefix_and_text = md.group('text')
-            text = prefix_and_text
-            text_i = 0
+            if pending_end > pending_start:
+                yield text[pending_start:pending_end]
+                pending_start = pending_end
+            yield md.group()
+            pos = md.end()
+            prefix_start = pos
             continue
-        if text.startswith('--]'):
-            tokens.append('--]')
-            prefix_and_text = text[3:]
-            text = prefix_and_text
-            text_i = 0
+        if text.startswith('--]', pos):
+            yield '--]'
+            pos += 3
+            prefix_start = pos
             continue
-        md = RX_ESCAPE_CHAR.search(text)
-        if md:
-            tokens.append(text[0:1])
-            prefix_and_text = text[1:]
-            text = prefix_and_text
-            text_i = 0
+        if pos <= last_escape:
+            yield char
+            pos += 1
+            prefix_start = pos
             continue
-        md = RX_DOUBLED_CHAR.search(text)
+        md = RX_DOUBLED_CHAR.match(text, pos)
         if md:
-            if prefix:
-                tokens.append(prefix)
-                prefix = ''
-            tokens.append(text[0:2])
-            prefix_and_text = text[2:]
-            text = prefix_and_text
-            text_i = 0
+            if pending_end > pending_start:
+                yield text[pending_start:pending_end]
+                pending_start = pending_end
+            yield MARKER_TOKENS[md.group()]
+            pos = md.end()
+            prefix_start = pos
             continue
-        if text.startswith('http'):
-            md = RX_URL.search(text)
+        if char == 'h':
+            md = RX_URL_TOKEN.match(text, pos)
             if md:
-                tokens.append(md.group('token'))
-                prefix_and_text = md.group('text')
-                text = prefix_and_text
-                text_i = 0
+                yield md.group()
+                pos = md.end()
+                prefix_start = pos
                 continue
-        text_i += 1
-        prefix = prefix_and_text[0:text_i]
-        text = prefix_and_text[text_i:]
+        md = RX_LEX_SPECIAL.search(text, pos + 1)
+        pos = md.start() if md else end
+        pending_start = prefix_start
+        pending_end = pos
+
+    if pending_end > pending_start:
+        yield text[pending_start:pending_end]
 
-    if prefix:
-        tokens.append(prefix)
 
-    return tokens
+def bracket_head_is_link(text, pos):
+    """
+    True if the text at *pos*, up to whitespace or ], is a URL or a
+    fragment, which is what a [single bracket] link needs.  Neither can
+    contain [, so the scans for successive brackets do not overlap.
+    """
+    if RX_URL_TOKEN.match(text, pos):
+        return True
+    md = RX_URL_FRAGMENT_HEAD.match(text, pos)
+    if md and md.end() < len(text):
+        next_char = text[md.end()]
+        return next_char == ']' or next_char.isspace()
+
+    return False
 
 
 class Token:
@@ -548,19 +750,19 @@ class Token:
 
 
 class LiteralStartToken(Token):
-    pass
+    markup = '@@'
 
 
 class LiteralEndToken(Token):
-    pass
+    markup = '@@'
 
 
 class HTMLEntityLiteralStartToken(Token):
-    pass
+    markup = '@<'
 
 
 class HTMLEntityLiteralEndToken(Token):
-    pass
+    markup = '>@'
 
 
 LITERAL_START_TOKEN = LiteralStartToken()
@@ -569,36 +771,73 @@ HTML_ENTITY_LITERAL_START_TOKEN = HTMLEntityLiteralStartToken()
 HTML_ENTITY_LITERAL_END_TOKEN = HTMLEntityLiteralEndToken()
 
 
-def count_literal_escapes(str_tokens):
-    prev_s = ''
-    literal_cnt = 0
-    for s in str_tokens:
-        if prev_s + s == '@@':
-            literal_cnt += 1
-            prev_s = ''
-        else:
-            prev_s = s
+def token_lex(text):
+    """
+    Returns an iterator over the tokens of inline content.  Only text
+    containing @ or > needs more than str_lex.
+    """
+    if '@' not in text and '>' not in text:
+        return str_lex(text)
 
-    return literal_cnt
+    return literal_token_lex(text)
 
 
-def token_lex(text):
+def literal_token_lex(text):
+    """
+    A @@ or @< which may start a literal is held back, together with the
+    tokens which follow it, until the matching @@ or >@ is seen.
+
+    A @@ only starts a literal if the line has another @@ pair after it,
+    so the @@ pairs in the string tokens are counted as they are read,
+    and read_ahead() reads further only when that is not yet known.
+    """
+    str_tokens = str_lex(text)
+    lookahead = collections.deque()
+    literal_cnt = 0
+    counted_s = ''
+
+    def read_ahead(n):
+        nonlocal literal_cnt, counted_s
+        while literal_cnt <= n:
+            s = next(str_tokens, None)
+            if s is None:
+                return False
+            if counted_s + s == '@@':
+                literal_cnt += 1
+                counted_s = ''
+            else:
+                counted_s = s
+            lookahead.append(s)
+
+        return True
+
+    tokens = []
     last_idx = -1
     last_html_entity_idx = -1
     prev_s = ''
-    str_tokens = str_lex(text)
-    tokens = []
-    remaining_literal_cnt = count_literal_escapes(str_tokens)
+    used_literal_cnt = 0
+
+    while True:
+        if lookahead:
+            s = lookahead.popleft()
+        else:
+            s = next(str_tokens, None)
+            if s is None:
+                break
+            if counted_s + s == '@@':
+                literal_cnt += 1
+                counted_s = ''
+            else:
+                counted_s = s
 
-    for s in str_tokens:
         if prev_s + s == '@@' and last_idx > -1:
-            remaining_literal_cnt -= 1
+            used_literal_cnt += 1
             tokens.append(LITERAL_END_TOKEN)
             tokens[last_idx] = LITERAL_START_TOKEN
             last_idx = -1
             prev_s = ''
-        elif prev_s + s == '@@' and remaining_literal_cnt > 1:
-            remaining_literal_cnt -= 1
+        elif prev_s + s == '@@' and read_ahead(used_literal_cnt + 1):
+            used_literal_cnt += 1
             tokens.append('@@')
             last_idx = len(tokens) - 1
             prev_s = ''
@@ -626,51 +865,58 @@ def token_lex(text):
                 prev_s = ''
             tokens.append(s)
 
-    return tokens
+        if tokens and last_idx == -1 and last_html_entity_idx == -1:
+            yield from tokens
+            tokens = []
+
+    yield from tokens
 
 
 class InlineParser:
+    """
+    Converts a token stream to a tree of Node and Text objects.
+
+    Each token is dispatched to a parse_* method: Token objects by class,
+    markers such as ** by value, and other strings by first character.
+    Whether a node of a given class is open is kept in *inside*; spans
+    nest, so for them a depth is kept instead.
+    """
+    MARKER_CLASSES = {
+        '--': StrikeThru,
+        '__': Underline,
+        '//': Italic,
+        '**': Bold,
+        ',,': Subscript,
+        '^^': Superscript,
+    }
+
     def __init__(self, wikidot):
         self.wikidot = wikidot
-        self.italic = False
-        self.bold = False
-        self.escape_literal = False
-        self.no_escape_literal = False
-        self.fixed_width = False
-        self.strike_thru = False
-        self.underline = False
-        self.subscript = False
-        self.superscript = False
+        self.inside = {
+            Italic: False,
+            Bold: False,
+            FixedWidth: False,
+            StrikeThru: False,
+            Underline: False,
+            Subscript: False,
+            Superscript: False,
+            Literal: False,
+            HTMLEntityLiteral: False,
+            Color: False,
+            Size: False,
+        }
         self.comment = False
         self.span_depth = 0
-        self.color = False
-        self.size = False
+        self.escaped_nodes = {Span: 0, Size: 0}
         self.top_node = Node(self.wikidot)
         self.nodes = [self.top_node]
-        self.tokens = None
 
     def __str__(self):
         return str(self.top_node)
 
     def set_flag(self, cls, value):
-        if cls == Italic:
-            self.italic = value
-        elif cls == Bold:
-            self.bold = value
-        elif cls == FixedWidth:
-            self.fixed_width = value
-        elif cls == StrikeThru:
-            self.strike_thru = value
-        elif cls == Underline:
-            self.underline = value
-        elif cls == Subscript:
-            self.subscript = value
-        elif cls == Superscript:
-            self.superscript = value
-        elif cls == Literal:
-            self.escape_literal = value
-        elif cls == HTMLEntityLiteral:
-            self.no_escape_literal = value
+        if cls in self.inside:
+            self.inside[cls] = value
         elif cls == Span:
             if value:
                 self.span_depth += 1
@@ -678,13 +924,7 @@ class InlineParser:
                 self.span_depth -= 1
             if self.span_depth < 0:
                 raise Exception('negative span depth')
-        elif cls == Color:
-            self.color = value
-        elif cls == Size:
-            self.size = value
-        elif cls == Node:
-            pass
-        else:
+        elif cls != Node:
             raise Exception('unknown class: {}'.format(cls))
 
     def remove_flag(self, cls):
@@ -707,12 +947,24 @@ class InlineParser:
         self.nodes = [self.top_node]
         self.restore_nodes(removed_nodes)
 
+    def next_top_node(self):
+        """
+        Starts a new top node, as for the next item of a list.  Nodes
+        left open are reopened in the new tree, and the old nodes are
+        closed if the new ones are.  Returns True in that case, since
+        the old tree cannot be rendered until they are.
+        """
+        if len(self.nodes) == 1:
+            self.top_node = Node(self.wikidot)
+            self.nodes = [self.top_node]
+            return False
+        self.restore_all_nodes(self.remove_all_nodes())
+
+        return True
+
     def restore_nodes(self, removed_nodes):
         while removed_nodes:
-            old_nd = removed_nodes.pop()
-            new_nd = type(old_nd)('')
-            old_nd.set_closure(new_nd)
-            self.add_node(new_nd)
+            self.add_node(removed_nodes.pop().reopen())
 
     def remove_nodes_to_class(self, cls_to_remove):
         removed_nodes = []
@@ -742,16 +994,27 @@ class InlineParser:
     def add_text(self, s):
         self.nodes[-1].children.append(s)
 
-    def handle_token(self, i, raw_tag, inside_tag, cls):
-        tokens = self.tokens
+    def open_node(self, nd, token):
+        """
+        Adds a span or size node, which unlike the other nodes can nest
+        without limit.  Past max_nesting_depth the token, and the tag
+        which closes it, are added as escaped text instead.
+        """
+        if len(self.nodes) > self.wikidot.max_nesting_depth:
+            self.escaped_nodes[type(nd)] += 1
+            self.add_text(html.escape(token))
+        else:
+            self.add_node(nd)
+
+    def handle_token(self, prev_token, next_token, raw_tag, inside_tag, cls):
         if inside_tag:
-            if i > 0 and not RX_WHITESPACE.match(tokens[i - 1]):
+            if prev_token is not None and not RX_WHITESPACE.match(prev_token):
                 nd = self.remove_node(cls)
-                nd.set_closure(CLOSED_NODE)
+                nd.mark_closed()
             else:
                 self.add_text(raw_tag)
         else:
-            if i < len(tokens) - 1 and not RX_WHITESPACE.match(tokens[i + 1]):
+            if next_token is not None and not RX_WHITESPACE.match(next_token):
                 self.add_node(cls(self.wikidot))
             else:
                 self.add_text(raw_tag)
@@ -778,179 +1041,300 @@ class InlineParser:
         else:
             self.add_text(token)
 
+    def parse_text(self, token, prev_token, next_token):
+        if token[0].isspace():
+            self.add_text(' ')
+        else:
+            self.add_text(html.escape(token))
+
+    def parse_whitespace(self, token, prev_token, next_token):
+        self.add_text(' ')
+
+    def parse_marker(self, token, prev_token, next_token):
+        cls = self.MARKER_CLASSES[token]
+        self.handle_token(prev_token, next_token, token, self.inside[cls], cls)
+
+    def parse_fixed_width_start(self, token, prev_token, next_token):
+        if not self.inside[FixedWidth]:
+            if next_token is not None and \
+               not RX_WHITESPACE.match(next_token):
+                self.add_node(FixedWidth(self.wikidot))
+            else:
+                self.add_text('{{')
+
+    def parse_fixed_width_end(self, token, prev_token, next_token):
+        if self.inside[FixedWidth]:
+            if prev_token is not None and not RX_WHITESPACE.match(prev_token):
+                nd = self.remove_node(FixedWidth)
+                nd.mark_closed()
+            else:
+                self.add_text('}}')
+
+    def parse_span_end(self, token, prev_token, next_token):
+        if self.escaped_nodes[Span]:
+            self.escaped_nodes[Span] -= 1
+            self.add_text(html.escape(token))
+        elif self.span_depth > 0:
+            nd = self.remove_node(Span)
+            nd.mark_closed()
+        else:
+            self.add_text(token)
+
+    def parse_size_end(self, token, prev_token, next_token):
+        if self.escaped_nodes[Size]:
+            self.escaped_nodes[Size] -= 1
+            self.add_text(html.escape(token))
+        elif self.inside[Size]:
+            nd = self.remove_node(Size)
+            nd.mark_closed()
+        else:
+            self.add_text(token)
+
+    def parse_color_end(self, token, prev_token, next_token):
+        if self.inside[Color]:
+            nd = self.remove_node(Color)
+            nd.mark_closed()
+        else:
+            self.add_text(token)
+
+    def parse_color(self, token, prev_token, next_token):
+        if not token.startswith('##'):
+            self.parse_text(token, prev_token, next_token)
+            return
+        if self.inside[Color]:
+            raise Exception('FIXME: nested color')
+        if token.endswith('|'):
+            color = token[2:-1]
+            if RX_RGB.search(color):
+                tag = 'span style="color: #{}"'.format(color.lower())
+            else:
+                tag = 'span style="color: {}"'.format(color)
+            self.add_node(Color(self.wikidot, token, tag))
+        else:
+            self.add_text(token)
+
+    def parse_bracket(self, token, prev_token, next_token):
+        if token.startswith('[[span'):
+            md = RX_SPAN.search(token)
+            if md:
+                attributes = md.groups()[0]
+                self.open_node(Span(self.wikidot, token, 'span {}'.format(attributes)), token)
+            else:
+                self.add_text(token)
+        elif token.startswith('[[size'):
+            md = RX_SIZE.search(token)
+            if md:
+                attributes = md.groups()[0]
+                self.open_node(
+                    Size(self.wikidot,
+                         token,
+                         'span style="font-size:{};"'.format(attributes)),
+                    token)
+            else:
+                self.add_text(token)
+        elif token.startswith('[[image'):
+            self.parse_image(token)
+        elif token.startswith('[[=image'):
+            self.parse_image(token)
+        elif token.startswith('[[['):
+            md = RX_PARSE_TRIPLE_BRACKET.search(token)
+            if md:
+                name = md.group('name') or md.group('href')
+                self.add_text(Link(self.wikidot,
+                                   token,
+                                   md.group('href'),
+                                   name))
+            else:
+                self.add_text(token)
+        elif token.startswith('[['):
+            md = RX_PARSE_DOUBLE_BRACKET.search(token)
+            if md:
+                self.add_text(Anchor(self.wikidot, token, md.group('anchor')))
+            else:
+                self.add_text(token)
+        else:
+            md = RX_PARSE_SINGLE_BRACKET.search(token)
+            if md:
+                self.add_text(
+                    Link(self.wikidot, token, md.group('href'), md.group('name')))
+            else:
+                self.add_text(token)
+
+    def parse_url(self, token, prev_token, next_token):
+        if token.startswith('http') and RX_URL.search(token):
+            self.add_text(Link(self.wikidot, token, token, token))
+        else:
+            self.add_text(html.escape(token))
+
+    def parse_literal_start(self, token):
+        self.add_node(Literal(
+            self.wikidot,
+            '@@',
+            'span style="white-space: pre-wrap;"'))
+
+    def parse_literal_end(self, token):
+        if self.inside[Literal]:
+            self.remove_node(Literal)
+        elif self.inside[HTMLEntityLiteral]:
+            self.add_text(token)
+        else:
+            raise Exception('unexpected token: {}'.format(type(token)))
+
+    def parse_html_entity_literal_start(self, token):
+        if self.inside[Literal] or self.inside[HTMLEntityLiteral]:
+            raise Exception('unexpected token: {}'.format(type(token)))
+        self.add_node(HTMLEntityLiteral(
+            self.wikidot,
+            '@@',
+            'span style="white-space: pre-wrap;"'))
+
+    def parse_html_entity_literal_end(self, token):
+        if self.inside[HTMLEntityLiteral]:
+            self.remove_node(HTMLEntityLiteral)
+        else:
+            self.add_text(html.escape('>@'))
+
+    TOKEN_HANDLERS = {
+        LiteralStartToken: parse_literal_start,
+        LiteralEndToken: parse_literal_end,
+        HTMLEntityLiteralStartToken: parse_html_entity_literal_start,
+        HTMLEntityLiteralEndToken: parse_html_entity_literal_end,
+    }
+
+    MARKER_HANDLERS = {
+        '--': parse_marker,
+        '__': parse_marker,
+        '//': parse_marker,
+        '**': parse_marker,
+        ',,': parse_marker,
+        '^^': parse_marker,
+        '{{': parse_fixed_width_start,
+        '}}': parse_fixed_width_end,
+        '##': parse_color_end,
+        '[[/span]]': parse_span_end,
+        '[[/size]]': parse_size_end,
+    }
+
+    FIRST_CHAR_HANDLERS = {
+        ' ': parse_whitespace,
+        '\t': parse_whitespace,
+        '[': parse_bracket,
+        '#': parse_color,
+        'h': parse_url,
+    }
+
+    def parse_line(self, text):
+        """
+        Parses a line of inline content.  A line longer than
+        max_line_length is not lexed, and the tokens after the first
+        max_line_tokens are not parsed; they are added as escaped text,
+        so the work done on a pathological line is bounded.
+        """
+        wikidot = self.wikidot
+        if len(text) > wikidot.max_line_length:
+            text = self.uncommented(text)
+            if text:
+                self.add_text(html.escape(text))
+            return self.top_node
+        if len(text) <= wikidot.max_line_tokens:
+            # no more tokens than characters
+            return self.parse(token_lex(text))
+        tokens = token_lex(text)
+        self.parse(itertools.islice(tokens, wikidot.max_line_tokens))
+        rest = ''.join(token if token.__class__ is str else token.markup for token in tokens)
+        rest = self.end_cut_line(rest)
+        if rest:
+            self.add_text(html.escape(rest))
+
+        return self.top_node
+
+    def end_cut_line(self, rest):
+        """
+        Closes the literals which the cut at max_line_tokens left open,
+        since unlike the other markup they cannot go on to the next line,
+        and returns the part of *rest* which is not inside a comment.
+        """
+        if self.inside[Literal]:
+            self.remove_node(Literal)
+        if self.inside[HTMLEntityLiteral]:
+            self.remove_node(HTMLEntityLiteral)
+
+        return self.uncommented(rest)
+
+    def uncommented(self, text):
+        """
+        Returns *text*, which is added without being parsed, less the
+        part inside a comment left open by the lines before it.
+        """
+        if not self.comment:
+            return text
+        end = text.find('--]')
+        if end < 0:
+            return ''
+        self.comment = False
+
+        return text[end + 3:]
+
     def parse(self, tokens):
-        self.tokens = tokens
-        for i, token in enumerate(tokens):
+        if self.wikidot.profile is None:
+            return self.parse_tokens(tokens)
+
+        return self.wikidot.profile.parse(self, tokens)
+
+    def parse_tokens(self, tokens):
+        marker_handlers = self.MARKER_HANDLERS
+        first_char_handlers = self.FIRST_CHAR_HANDLERS
+        parse_text = InlineParser.parse_text
+        inside = self.inside
+        tokens = iter(tokens)
+        prev_token = None
+        next_token = next(tokens, None)
+        while next_token is not None:
+            token = next_token
+            next_token = next(tokens, None)
             if self.comment:
-                if token != '--]':
-                    pass
-                elif token == '--]':
+                if token == '--]':
                     self.comment = False
             elif token == '[!--':
                 self.comment = True
-            elif isinstance(token, LiteralEndToken) and self.escape_literal:
-                self.escape_literal = False
-                self.remove_node(Literal)
-            elif isinstance(token, LiteralStartToken):
-                self.escape_literal = True
-                self.add_node(Literal(
-                    self.wikidot,
-                    '@@',
-                    'span style="white-space: pre-wrap;"'))
-            elif isinstance(token, HTMLEntityLiteralEndToken) \
-                    and self.no_escape_literal:
-                self.no_escape_literal = False
-                self.remove_node(HTMLEntityLiteral)
-            elif isinstance(token, HTMLEntityLiteralEndToken):
-                self.add_text(html.escape('>@'))
-            elif self.escape_literal:
+            elif token.__class__ is not str:
+                handler = self.TOKEN_HANDLERS.get(token.__class__)
+                if handler is None:
+                    raise Exception('expected token to be a string: ' +
+                                    str(type(token)) + ': ' +
+                                    str(token))
+                handler(self, token)
+            elif inside[Literal]:
                 self.add_text(html.escape(token))
-            elif self.no_escape_literal:
+            elif inside[HTMLEntityLiteral]:
                 self.add_text(token)
-            elif isinstance(token, HTMLEntityLiteralStartToken):
-                self.no_escape_literal = True
-                self.add_node(HTMLEntityLiteral(
-                    self.wikidot,
-                    '@@',
-                    'span style="white-space: pre-wrap;"'))
-            elif not isinstance(token, str):
-                raise Exception('expected token to be a string: ' +
-                                str(type(token)) + ': ' +
-                                str(token))
-            elif RX_WHITESPACE.match(token):
-                self.add_text(' ')
-            elif token.startswith('[[span'):
-                md = RX_SPAN.search(token)
-                if md:
-                    attributes = md.groups()[0]
-                    self.add_node(Span(self.wikidot, token, 'span {}'.format(attributes)))
-                else:
-                    self.add_text(token)
-            elif token == '[[/span]]':
-                if self.span_depth > 0:
-                    nd = self.remove_node(Span)
-                    nd.set_closure(CLOSED_NODE)
-                else:
-                    self.add_text(token)
-            elif token.startswith('[[size'):
-                md = RX_SIZE.search(token)
-                if md:
-                    attributes = md.groups()[0]
-                    self.add_node(
-                        Size(self.wikidot,
-                             token,
-                             'span style="font-size:{};"'.format(attributes)))
-                else:
-                    self.add_text(token)
-            elif token == '[[/size]]':
-                if self.size:
-                    nd = self.remove_node(Size)
-                    nd.set_closure(CLOSED_NODE)
-                else:
-                    self.add_text(token)
-            elif token.startswith('[[image'):
-                self.parse_image(token)
-            elif token.startswith('[[=image'):
-                self.parse_image(token)
-            elif token.startswith('[[['):
-                md = RX_PARSE_TRIPLE_BRACKET.search(token)
-                if md:
-                    name = md.group('name') or md.group('href')
-                    self.add_text(Link(self.wikidot,
-                                       token,
-                                       md.group('href'),
-                                       name))
-                else:
-                    self.add_text(token)
-            elif token.startswith('[['):
-                md = RX_PARSE_DOUBLE_BRACKET.search(token)
-                if md:
-                    self.add_text(Anchor(self.wikidot, token, md.group('anchor')))
-                else:
-                    self.add_text(token)
-            elif token.startswith('['):
-                md = RX_PARSE_SINGLE_BRACKET.search(token)
-                if md:
-                    self.add_text(
-                        Link(self.wikidot, token, md.group('href'), md.group('name')))
-                else:
-                    self.add_text(token)
-            elif token == '##':
-                if self.color:
-                    nd = self.remove_node(Color)
-                    nd.set_closure(CLOSED_NODE)
-                else:
-                    self.add_text(token)
-            elif token.startswith('##'):
-                if self.color:
-                    raise Exception('FIXME: nested color')
-                if token.endswith('|'):
-                    color = token[2:-1]
-                    if RX_RGB.search(color):
-                        tag = 'span style="color: #{}"'.format(color.lower())
-                    else:
-                        tag = 'span style="color: {}"'.format(color)
-                    self.add_node(Color(self.wikidot, token, tag))
-                else:
-                    self.add_text(token)
-            elif token == '--':
-                self.handle_token(i, '--', self.strike_thru, StrikeThru)
-            elif token == '__':
-                self.handle_token(i, '__', self.underline, Underline)
-            elif token == '//':
-                self.handle_token(i, '//', self.italic, Italic)
-            elif token == '**':
-                self.handle_token(i, '**', self.bold, Bold)
-            elif token == ',,':
-                self.handle_token(i, ',,', self.subscript, Subscript)
-            elif token == '^^':
-                self.handle_token(i, '^^', self.superscript, Superscript)
-            elif token == '{{':
-                if not self.fixed_width:
-                    if i < len(tokens) - 1 and \
-                       not RX_WHITESPACE.match(tokens[i + 1]):
-                        self.add_node(FixedWidth(self.wikidot))
-                    else:
-                        self.add_text('{{')
-            elif token == '}}':
-                if self.fixed_width:
-                    if i > 0 and not RX_WHITESPACE.match(tokens[i - 1]):
-                        nd = self.remove_node(FixedWidth)
-                        nd.set_closure(CLOSED_NODE)
-                    else:
-                        self.add_text('}}')
-            elif token.startswith('http'):
-                md = RX_URL.search(token)
-                if md:
-                    self.add_text(Link(self.wikidot, token, token, token))
-                else:
-                    self.add_text(html.escape(token))
             else:
-                self.add_text(html.escape(token))
+                handler = marker_handlers.get(token) or first_char_handlers.get(token[0], parse_text)
+                handler(self, token, prev_token, next_token)
+            prev_token = token
 
         return self.top_node
 
 
-def analyze_line(line, current_block):
-    if not current_block or current_block.block_type != BLOCK_TYPE_TABLE:
-        md = RX_UL.search(line)
-        if md:
-            return BLOCK_TYPE_UL, md
-        md = RX_OL.search(line)
-        if md:
-            return BLOCK_TYPE_OL, md
-        md = RX_HN.search(line)
-        if md:
-            return BLOCK_TYPE_HN, md
-        md = RX_HR.search(line)
-        if md:
-            return BLOCK_TYPE_HR, md
-    md = RX_TABLE.search(line)
-    if md:
-        return BLOCK_TYPE_TABLE, md
-    md = RX_EMPTY.search(line)
-    if md:
-        return BLOCK_TYPE_EMPTY, md
+def analyze_line(line, current_block, lead=None):
+    """
+    *lead* is the first character of the line which is not whitespace,
+    or '' if there is none.  It picks the one regex other than RX_P
+    which can match.  Inside a table only tables and empty lines end
+    the paragraph.
+    """
+    if lead is None:
+        lead = line.lstrip()[:1]
+    candidate = LINE_TYPE_CANDIDATES.get(lead)
+    if candidate:
+        block_type, rx = candidate
+        if (block_type == BLOCK_TYPE_TABLE or
+                block_type == BLOCK_TYPE_EMPTY or
+                not current_block or
+                current_block.block_type != BLOCK_TYPE_TABLE):
+            md = rx.search(line)
+            if md:
+                return block_type, md
     md = RX_P.search(line)
     if md:
         return BLOCK_TYPE_P, md
@@ -963,6 +1347,8 @@ class Block:
         self.wikidot = wikidot
         self.lines = [line]
         self.linenos = [lineno]
+        self.first_lineno = lineno
+        self.last_lineno = lineno
         if block_type:
             self.block_type = block_type
             self.matches = [match]
@@ -975,6 +1361,7 @@ class Block:
                  block_type=None, match=None, continued=False):
         self.lines.append(line)
         self.linenos.append(lineno)
+        self.last_lineno = lineno
         if block_type is None:
             block_type, match = analyze_line(line, None)
         if not continued and \
@@ -991,20 +1378,27 @@ class Block:
     def multiline_type(self):
         return self.block_type in MULTILINE_BLOCK_TYPES
 
+    def memo_key(self):
+        """
+        The key under which BlockMemo stores the rendered block, or None
+        if the output depends on more than the lines.
+        """
+        return (type(self), self.block_type, tuple(self.lines))
+
     def write_open_tag(self, output_stream):
         output_stream.write('<{}>'.format(self.tag))
 
     def content(self):
         parser = InlineParser(self.wikidot)
         for match in self.matches:
-            parser.parse(token_lex(match.group('content')))
+            parser.parse_line(match.group('content'))
 
         return str(parser.top_node)
 
     def write_content(self, parser, output_stream):
         for match in self.matches:
-            parser.parse(token_lex(match.group('content')))
-            output_stream.write(str(parser.top_node))
+            parser.parse_line(match.group('content'))
+        output_stream.write(str(parser.top_node))
 
     def write_close_tag(self, output_stream):
         output_stream.write('</{}>\n'.format(self.tag))
@@ -1016,26 +1410,28 @@ class Block:
         self.write_close_tag(output_stream)
 
 
+TocEntry = collections.namedtuple('TocEntry', ['level', 'anchor', 'text'])
+
+
 class TOC:
+    """
+    The headings of a page, as a TocEntry each: the level, 1 for +, the
+    id of the heading and its text rendered as HTML.
+    """
     def __init__(self, wikidot):
         self.wikidot = wikidot
         self.headers = []
 
     def add_header(self, header):
-        self.headers.append({
-            'n': header.n(),
-            'toc_number': header.toc_number,
-            'text': header.content()
-        })
+        self.headers.append(TocEntry(header.n(), header.anchor(), header.text))
 
     def close(self, output_stream):
         output_stream.write('<div id="toc">\n')
         output_stream.write('<div class="title">Table of Contents</div>\n')
         output_stream.write('<div id="toc-list">\n')
         for header in self.headers:
-            output_stream.write('<div style="margin-left: {}em;">\n'.format(header['n'] + 1))
-            output_stream.write('<a href="#toc{}">{}</a>\n'.format(header['toc_number'],
-                                                                   header['text']))
+            output_stream.write('<div style="margin-left: {}em;">\n'.format(header.level + 1))
+            output_stream.write('<a href="#{}">{}</a>\n'.format(header.anchor, header.text))
             output_stream.write('</div>\n')
         output_stream.write('</div>\n')
         output_stream.write('</div>\n')
@@ -1047,11 +1443,24 @@ class Header(Block):
         self.wikidot = wikidot
         self.toc_number = self.wikidot.next_toc_number
         self.wikidot.next_toc_number += 1
+        self.text = self.content()
         self.wikidot.toc.add_header(self)
 
+    def anchor(self):
+        return 'toc{}'.format(self.toc_number)
+
     def write_open_tag(self, output_stream):
-        output_stream.write('<{} id="toc{}"><span>'.format(self.tag,
-                                                           self.toc_number))
+        output_stream.write('<{} id="{}"><span>'.format(self.tag, self.anchor()))
+
+    def write_content(self, parser, output_stream):
+        """
+        The text was rendered for the table of contents; only a heading
+        continued onto more lines is parsed again.
+        """
+        if len(self.matches) == 1:
+            output_stream.write(self.text)
+        else:
+            Block.write_content(self, parser, output_stream)
 
     def write_close_tag(self, output_stream):
         output_stream.write('</span></{}>\n'.format(self.tag))
@@ -1059,6 +1468,9 @@ class Header(Block):
     def n(self):
         return len(self.matches[0].group('plus_signs'))
 
+    def memo_key(self):
+        return None
+
     def _tag(self):
         return 'h{}'.format(self.n())
 
@@ -1067,6 +1479,9 @@ class HorizontalRule(Block):
     def __init__(self, wikidot, line, lineno, match):
         Block.__init__(self, wikidot, line, lineno, BLOCK_TYPE_HR, match)
 
+    def memo_key(self):
+        return None
+
     def close(self, output_stream):
         output_stream.write('<hr />\n')
 
@@ -1080,12 +1495,14 @@ class Table(Block):
         self.text_align = None
         self.cell_content = ''
         self.parser = None
+        self.opened = False
+        self.inside_cell = False
 
     def start_cell(self):
         self.parser = InlineParser(self.wikidot)
 
     def add_cell_content(self, content):
-        self.parser.parse(token_lex(content))
+        self.parser.parse_line(content)
 
     def add_line_break(self):
         self.parser.add_text(self.wikidot.LINE_BREAK)
@@ -1208,67 +1625,84 @@ class Table(Block):
 
         return cells
 
-    def close(self, output_stream):
-        output_stream.write('<table class="wiki-content-table">\n')
-        inside_cell = False
-        for i, match in enumerate(self.matches):
+    def memo_key(self):
+        return None
+
+    def write_rows(self, output_stream):
+        """
+        Writes the lines added since the last call and forgets them.
+        BlockParser calls it after every line, so each row is written
+        as soon as it is complete and only the cell being read is kept,
+        however long the table.
+        """
+        if not self.opened:
+            output_stream.write('<table class="wiki-content-table">\n')
+            self.opened = True
+        for match, lineno in zip(self.matches, self.linenos):
             try:
-                content = match.group('content')
-            except IndexError:
-                content = ''
-            try:
-                md = RX_FULL_ROW.search(content)
-                if md:
-                    if inside_cell:
-                        raise Exception('unterminated cell')
-                    row = md.group('row')
-                    cells = self.row_to_cells(row)
-                    output_stream.write('<tr>\n')
-                    self.print_cells(output_stream, None, cells, None)
-                    output_stream.write('</tr>\n')
-                    inside_cell = False
-                    continue
-                md = RX_START_ROW.search(content)
-                if md:
-                    if inside_cell:
-                        raise Exception('unterminated cell')
-                    row = md.group('row')
-                    cells = self.row_to_cells(row)
-                    last_cell = cells.pop()
-                    output_stream.write('<tr>\n')
-                    self.print_cells(output_stream, None, cells, last_cell)
-                    inside_cell = True
-                    continue
-                md = RX_END_ROW.search(content)
-                if md:
-                    if not inside_cell:
-                        raise Exception('not inside cell')
-                    row = md.group('row')
-                    cells = self.row_to_cells(row)
-                    first_cell = cells.pop(0)
-                    self.print_cells(output_stream, first_cell, cells, None)
-                    output_stream.write('</tr>\n')
-                    inside_cell = False
-                    continue
-                row = content
-                cells = self.row_to_cells(row)
-                if len(cells) == 1:
-                    lone_cell = cells.pop()
-                    self.print_cells(output_stream, None, [], None, lone_cell)
-                else:
-                    first_cell = cells.pop(0)
-                    last_cell = cells.pop()
-                    self.print_cells(output_stream,
-                                     first_cell,
-                                     cells,
-                                     last_cell)
-                inside_cell = True
+                self.write_row(output_stream, match)
             except Exception:
-                if i < len(self.linenos):
-                    sys.stderr.write(
-                        "ERROR line number at source: {}\n".format(
-                            self.linenos[i]))
+                sys.stderr.write(
+                    "ERROR line number at source: {}\n".format(lineno))
                 raise
+        self.lines = []
+        self.linenos = []
+        self.matches = []
+
+    def write_row(self, output_stream, match):
+        try:
+            content = match.group('content')
+        except IndexError:
+            content = ''
+        md = RX_FULL_ROW.search(content)
+        if md:
+            if self.inside_cell:
+                raise Exception('unterminated cell')
+            row = md.group('row')
+            cells = self.row_to_cells(row)
+            output_stream.write('<tr>\n')
+            self.print_cells(output_stream, None, cells, None)
+            output_stream.write('</tr>\n')
+            self.inside_cell = False
+            return
+        md = RX_START_ROW.search(content)
+        if md:
+            if self.inside_cell:
+                raise Exception('unterminated cell')
+            row = md.group('row')
+            cells = self.row_to_cells(row)
+            last_cell = cells.pop()
+            output_stream.write('<tr>\n')
+            self.print_cells(output_stream, None, cells, last_cell)
+            self.inside_cell = True
+            return
+        md = RX_END_ROW.search(content)
+        if md:
+            if not self.inside_cell:
+                raise Exception('not inside cell')
+            row = md.group('row')
+            cells = self.row_to_cells(row)
+            first_cell = cells.pop(0)
+            self.print_cells(output_stream, first_cell, cells, None)
+            output_stream.write('</tr>\n')
+            self.inside_cell = False
+            return
+        row = content
+        cells = self.row_to_cells(row)
+        if len(cells) == 1:
+            lone_cell = cells.pop()
+            self.print_cells(output_stream, None, [], None, lone_cell)
+        else:
+            first_cell = cells.pop(0)
+            last_cell = cells.pop()
+            self.print_cells(output_stream,
+                             first_cell,
+                             cells,
+                             last_cell)
+        self.inside_cell = True
+
+    def close(self, output_stream):
+        self.write_rows(output_stream)
         output_stream.write('</table>\n')
 
 
@@ -1283,6 +1717,7 @@ class List(Block):
                        match)
         self.opened_lists = None
         self.inside_line = None
+        self.last_indent = -1
 
     def raw_tag_to_tag(self, raw_tag):
         if raw_tag == '*':
@@ -1319,39 +1754,48 @@ class List(Block):
     def write_list_content(self, output_stream, node):
         output_stream.write(str(node))
 
+    def write_item(self, output_stream, node, tag, indent):
+        for i in range(indent, self.last_indent):
+            self.close_list(output_stream, i + 1)
+        for i in range(self.last_indent, indent):
+            self.open_list(output_stream, tag, i + 1)
+        self.open_line(output_stream, indent)
+        self.write_list_content(output_stream, node)
+        self.last_indent = indent
+
     def close(self, output_stream):
+        """
+        Items are written as they are parsed, except that an item with
+        inline markup left open waits until the markup is closed or the
+        list ends, since that decides how the item renders.
+        """
         parser = InlineParser(self.wikidot)
-        node_tag_indent = []
-        triple = None
+        self.last_indent = -1
+        self.opened_lists = []
+        self.inside_line = {}
+        waiting_items = []
+        tag = indent = None
         for match in self.matches:
-            if not triple:
-                triple = [None,
-                          self.raw_tag_to_tag(match.group('raw_tag')),
-                          len(match.group('indent'))]
-            content = match.group('content')
-            parser.parse(token_lex(content))
+            if tag is None:
+                tag = self.raw_tag_to_tag(match.group('raw_tag'))
+                indent = len(match.group('indent'))
+            parser.parse_line(match.group('content'))
             if match.group('br'):
                 parser.add_text(self.wikidot.LINE_BREAK)
+                continue
+            node = parser.top_node
+            if parser.next_top_node():
+                waiting_items.append((node, tag, indent))
             else:
-                triple[0] = parser.top_node
-                node_tag_indent.append(triple)
-                triple = None
-                removed_nodes = parser.remove_all_nodes()
-
-                parser.restore_all_nodes(removed_nodes)
-
-        last_indent = -1
-        self.opened_lists = []
-        self.inside_line = {}
-        for node, tag, indent in node_tag_indent:
-            for i in range(indent, last_indent):
-                self.close_list(output_stream, i + 1)
-            for i in range(last_indent, indent):
-                self.open_list(output_stream, tag, i + 1)
-            self.open_line(output_stream, indent)
-            self.write_list_content(output_stream, node)
-            last_indent = indent
-        for i in range(-1, last_indent):
+                for waiting_item in waiting_items:
+                    self.write_item(output_stream, *waiting_item)
+                waiting_items = []
+                self.write_item(output_stream, node, tag, indent)
+            tag = indent = None
+
+        for waiting_item in waiting_items:
+            self.write_item(output_stream, *waiting_item)
+        for i in range(-1, self.last_indent):
             self.close_list(output_stream, i + 1)
 
 
@@ -1359,15 +1803,50 @@ class Empty(Block):
     def __init__(self, wikidot, line, lineno, match):
         Block.__init__(self, wikidot, line, lineno, BLOCK_TYPE_EMPTY, match)
 
+    def memo_key(self):
+        return None
+
     def close(self, output_stream):
         pass
 
 
-class Code(Block):
-    def __init__(self, wikidot, line, lineno, match):
+class RawBlock(Block):
+    """
+    A code, html or math block, whose lines are written as they are or
+    escaped rather than parsed.  Only the lines are kept, and they are
+    joined and escaped in one go when the block closes.
+    """
+    def __init__(self, wikidot, line, lineno, block_type, match):
         self.input_nesting_level = 0
         self.output_nesting_level = 0
-        Block.__init__(self, wikidot, line, lineno, BLOCK_TYPE_CODE, match)
+        Block.__init__(self, wikidot, line, lineno, block_type, match)
+        self.first_content = match.group('content')
+
+    def add_line(self, line, lineno,
+                 block_type=None, match=None, continued=False):
+        self.lines.append(line)
+        self.linenos.append(lineno)
+        self.last_lineno = lineno
+
+    def raw_content(self, skip_blank_first_line=False):
+        """
+        The text after the start tag and the lines after it, joined with
+        newlines.
+        """
+        rest = '\n'.join(itertools.islice(self.lines, 1, None))
+        if skip_blank_first_line and RX_BLANK_LINE.search(self.first_content):
+            return rest
+        if len(self.lines) == 1:
+            return self.first_content
+        return self.first_content + '\n' + rest
+
+
+class Code(RawBlock):
+    def __init__(self, wikidot, line, lineno, match):
+        RawBlock.__init__(self, wikidot, line, lineno, BLOCK_TYPE_CODE, match)
+
+    def memo_key(self):
+        return Block.memo_key(self) + (self.output_nesting_level,)
 
     def write_open_tag(self, output_stream):
         output_stream.write('<div class="code">\n')
@@ -1380,12 +1859,7 @@ class Code(Block):
             output_stream.write('[[code]]\n')
             n -= 1
 
-        for i, match in enumerate(self.matches):
-            if i == 0 and RX_BLANK_LINE.search(match.group('content')):
-                continue
-            output_stream.write(html.escape(match.group('content'), quote=True))
-            if i < len(self.matches) - 1:
-                output_stream.write('\n')
+        output_stream.write(html.escape(self.raw_content(skip_blank_first_line=True), quote=True))
 
         while self.output_nesting_level > 0:
             output_stream.write('\n[[/code]]')
@@ -1401,29 +1875,27 @@ class Code(Block):
         self.write_close_tag(output_stream)
 
 
-class HTML(Block):
+class HTML(RawBlock):
     def __init__(self, wikidot, line, lineno, match):
-        self.input_nesting_level = 0
-        self.output_nesting_level = 0
-        Block.__init__(self, wikidot, line, lineno, BLOCK_TYPE_HTML, match)
+        RawBlock.__init__(self, wikidot, line, lineno, BLOCK_TYPE_HTML, match)
 
     def write_html_content(self, output_stream):
-        for match in self.matches:
-            output_stream.write(match.group('content'))
-            output_stream.write('\n')
+        output_stream.write(self.raw_content())
+        output_stream.write('\n')
 
     def close(self, output_stream):
         self.write_html_content(output_stream)
 
 
-class Math(Block):
+class Math(RawBlock):
     def __init__(self, wikidot, line, lineno, match):
-        self.input_nesting_level = 0
-        self.output_nesting_level = 0
-        Block.__init__(self, wikidot, line, lineno, BLOCK_TYPE_MATH, match)
+        RawBlock.__init__(self, wikidot, line, lineno, BLOCK_TYPE_MATH, match)
         self.eqn_number = self.wikidot.next_eqn_number
         self.wikidot.next_eqn_number += 1
 
+    def memo_key(self):
+        return None
+
     def write_open_tag(self, output_stream):
         output_stream.write(
             '<span class="equation-number">({})</span>\n'.format(
@@ -1439,12 +1911,7 @@ class Math(Block):
             output_stream.write('[[math]]\n')
             n -= 1
 
-        for i, match in enumerate(self.matches):
-            if i == 0 and RX_BLANK_LINE.search(match.group('content')):
-                continue
-            output_stream.write(html.escape(match.group('content'), quote=True))
-            if i < len(self.matches) - 1:
-                output_stream.write('\n')
+        output_stream.write(html.escape(self.raw_content(skip_blank_first_line=True), quote=True))
 
         while self.output_nesting_level > 0:
             output_stream.write('\n[[/math]]')
@@ -1467,7 +1934,7 @@ class Paragraph(Block):
 
     def get_content(self, parser):
         for i, match in enumerate(self.matches):
-            parser.parse(token_lex(match.group('content')))
+            parser.parse_line(match.group('content'))
             if i < len(self.matches) - 1:
                 parser.add_text(self.wikidot.LINE_BREAK)
 
@@ -1537,7 +2004,6 @@ class BlockParser:
     def __init__(self, wikidot, input_stream):
         self.wikidot = wikidot
         self.input_stream = input_stream
-        self.input_lines = self.input_stream.readlines()
         self.current_block = None
         self.bq_level = 0
         self.continued_line = False
@@ -1546,9 +2012,24 @@ class BlockParser:
 
     def close_current_block(self, output_stream):
         if self.current_block:
-            self.current_block.close(output_stream)
+            if self.wikidot.profile is not None:
+                self.wikidot.profile.close_block(self, output_stream)
+            else:
+                self.close_block(output_stream)
         self.current_block = None
 
+    def write_rows(self, output_stream):
+        if self.wikidot.profile is not None:
+            self.wikidot.profile.write_rows(self, output_stream)
+        else:
+            self.current_block.write_rows(output_stream)
+
+    def close_block(self, output_stream):
+        if self.wikidot.block_memo is not None:
+            self.wikidot.block_memo.close(self.current_block, output_stream)
+        else:
+            self.current_block.close(output_stream)
+
     def block_factory(self, line, lineno, block_type=None, match=None):
         if block_type == BLOCK_TYPE_UL:
             return List(wikidot=self.wikidot, line=line, lineno=lineno, match=match)
@@ -1580,7 +2061,7 @@ class BlockParser:
         if isinstance(self.current_block, Code):
             return line
 
-        md = RX_BLOCKQUOTE.search(line)
+        md = RX_BLOCKQUOTE.search(line) if line[:1] == '>' else None
         if md:
             new_bq_level = len(md.group('greater_than_signs'))
             line = md.group('content')
@@ -1623,62 +2104,53 @@ class BlockParser:
             div = self.divs.pop()
             div.close(output_stream)
 
-    def block_type_and_match(self, output_stream, line):
+    def block_type_and_match(self, output_stream, line, lead):
         if isinstance(self.current_block, Code):
-            md = RX_CODE_START.search(line)
+            md = RX_CODE_START.search(line) if lead == '[' else None
             if md:
                 self.current_block.input_nesting_level += 1
                 self.current_block.output_nesting_level += 1
                 return None, None
-            md = RX_CODE_END.search(line)
+            md = RX_CODE_END.search(line) if lead == '[' else None
             if md:
                 if self.current_block.input_nesting_level == 0:
                     self.close_current_block(output_stream)
                     return None, None
                 self.current_block.input_nesting_level -= 1
                 return None, None
-            md = RX_CODE_CONTENT.search(line)
-            if md:
-                return BLOCK_TYPE_CODE, md
-            raise Exception('unparseable line: {}'.format(line))
+            return BLOCK_TYPE_CODE, None
 
         if isinstance(self.current_block, HTML):
-            md = RX_HTML_START.search(line)
+            md = RX_HTML_START.search(line) if lead == '[' else None
             if md:
                 self.current_block.input_nesting_level += 1
                 self.current_block.output_nesting_level += 1
                 return None, None
-            md = RX_HTML_END.search(line)
+            md = RX_HTML_END.search(line) if lead == '[' else None
             if md:
                 if self.current_block.input_nesting_level == 0:
                     self.close_current_block(output_stream)
                     return None, None
                 self.current_block.input_nesting_level -= 1
                 return None, None
-            md = RX_HTML_CONTENT.search(line)
-            if md:
-                return BLOCK_TYPE_HTML, md
-            raise Exception('unparseable line: {}'.format(line))
+            return BLOCK_TYPE_HTML, None
 
         if isinstance(self.current_block, Math):
-            md = RX_MATH_START.search(line)
+            md = RX_MATH_START.search(line) if lead == '[' else None
             if md:
                 self.current_block.input_nesting_level += 1
                 self.current_block.output_nesting_level += 1
                 return None, None
-            md = RX_MATH_END.search(line)
+            md = RX_MATH_END.search(line) if lead == '[' else None
             if md:
                 if self.current_block.input_nesting_level == 0:
                     self.close_current_block(output_stream)
                     return None, None
                 self.current_block.input_nesting_level -= 1
                 return None, None
-            md = RX_MATH_CONTENT.search(line)
-            if md:
-                return BLOCK_TYPE_MATH, md
-            raise Exception('unparseable line: {}'.format(line))
+            return BLOCK_TYPE_MATH, None
 
-        if self.bq_level == 0:
+        if self.bq_level == 0 and lead == '[':
             md = RX_CODE_START.search(line)
             if md:
                 self.close_current_block(output_stream)
@@ -1692,79 +2164,286 @@ class BlockParser:
                 self.close_current_block(output_stream)
                 return BLOCK_TYPE_MATH, md
 
-        return analyze_line(line, self.current_block)
+        return analyze_line(line, self.current_block, lead)
 
-    def _process_lines(self, output_stream):
-        try:
-            for lineno, line in enumerate(self.input_lines, start=1):
-                line = line.rstrip()
-                line = self.adjust_blockquote_level(output_stream, line)
-
-                if line == TOC_LITERAL and self.toc:
-                    self.toc.close(output_stream)
-                    continue
+    def process_line(self, output_stream, lineno, line):
+        line = line.rstrip()
+        line = self.adjust_blockquote_level(output_stream, line)
 
-                if self.check_for_div(output_stream, line):
-                    continue
-
-                block_type, match = self.block_type_and_match(output_stream, line)
-                if not block_type:
-                    continue
-
-                if block_type == BLOCK_TYPE_EMPTY and self.bq_level > 0:
-                    continue
+        if line == TOC_LITERAL and self.toc:
+            if isinstance(self.current_block, Table):
+                self.close_current_block(output_stream)
+            output_stream.write_placeholder(self.toc)
+            return
+
+        lead = line.lstrip()[:1]
+        if lead == '[' and self.check_for_div(output_stream, line):
+            return
+
+        block_type, match = self.block_type_and_match(output_stream, line, lead)
+        if not block_type:
+            return
+
+        if block_type == BLOCK_TYPE_EMPTY and self.bq_level > 0:
+            return
+
+        if not self.current_block:
+            self.current_block = self.block_factory(line,
+                                                    lineno,
+                                                    block_type,
+                                                    match)
+        elif self.continued_line:
+            self.current_block.add_line(line,
+                                        lineno,
+                                        block_type,
+                                        match,
+                                        continued=True)
+        elif (block_type == self.current_block.block_type and
+              self.current_block.multiline_type()):
+            self.current_block.add_line(line,
+                                        lineno,
+                                        block_type,
+                                        match)
+        else:
+            self.close_current_block(output_stream)
+            self.current_block = self.block_factory(line,
+                                                    lineno,
+                                                    block_type,
+                                                    match)
 
-                if not self.current_block:
-                    self.current_block = self.block_factory(line,
-                                                            lineno,
-                                                            block_type,
-                                                            match)
-                elif self.continued_line:
-                    self.current_block.add_line(line,
-                                                lineno,
-                                                block_type,
-                                                match,
-                                                continued=True)
-                elif (block_type == self.current_block.block_type and
-                      self.current_block.multiline_type()):
-                    self.current_block.add_line(line,
-                                                lineno,
-                                                block_type,
-                                                match)
-                else:
-                    self.close_current_block(output_stream)
-                    self.current_block = self.block_factory(line,
-                                                            lineno,
-                                                            block_type,
-                                                            match)
+        if isinstance(self.current_block, Table):
+            self.write_rows(output_stream)
 
-                try:
-                    self.continued_line = line.endswith(' _')
-                except IndexError:
-                    self.continued_line = False
+        try:
+            self.continued_line = line.endswith(' _')
+        except IndexError:
+            self.continued_line = False
+
+    def finish(self, output_stream):
+        self.close_current_block(output_stream)
+        self.adjust_blockquote_level(output_stream, '')
+
+    def at_restart_point(self):
+        """
+        True when no block is open, so the lines which follow render the
+        same whatever preceded them, save for the open divs and the TOC
+        and equation counters.
+        """
+        return ((self.current_block is None or isinstance(self.current_block, Empty)) and
+                self.bq_level == 0 and
+                not self.continued_line)
 
-            self.close_current_block(output_stream)
-            self.adjust_blockquote_level(output_stream, '')
+    def _process_lines(self, output_stream):
+        profile = self.wikidot.profile
+        lineno, line = 0, ''
+        try:
+            if profile is None:
+                for lineno, line in enumerate(self.input_stream, start=1):
+                    self.process_line(output_stream, lineno, line)
+                self.finish(output_stream)
+            else:
+                for lineno, line in enumerate(self.input_stream, start=1):
+                    profile.run_line(lineno, self.process_line, output_stream, lineno, line)
+                profile.run_line(lineno, self.finish, output_stream)
         except Exception:
-            sys.stderr.write("ERROR at line {}: {}\n".format(lineno, line))
+            sys.stderr.write("ERROR at line {}: {}\n".format(lineno, line.rstrip()))
             raise
 
     def process_lines(self, output_stream):
-        self._process_lines(NullOutputStream())
-
         self.wikidot.next_toc_number = 0
         self.wikidot.next_eqn_number = 1
-        self.toc = self.wikidot.toc
         self.wikidot.toc = TOC(self.wikidot)
+        self.toc = self.wikidot.toc
 
-        self._process_lines(output_stream)
+        segmented_stream = SegmentedOutputStream(output_stream, buffer_size=self.wikidot.output_buffer_size)
+        try:
+            self._process_lines(segmented_stream)
+        except Exception:
+            segmented_stream.write_pending()
+            raise
+        segmented_stream.flush()
+
+
+class BlockMemo:
+    """
+    Remembers the rendered output of blocks, so that a block which
+    occurs again, in the same document or a later one, is not lexed and
+    parsed again.  The least recently used blocks are dropped once the
+    stored output exceeds *max_size* characters.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.rendered = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def close(self, block, output_stream):
+        key = block.memo_key()
+        if key is None:
+            block.close(output_stream)
+            return
+        wikidot = block.wikidot
+        key = (wikidot.image_prefix,
+               wikidot.link_prefix,
+               wikidot.link_suffix,
+               wikidot.max_line_length,
+               wikidot.max_line_tokens,
+               wikidot.max_nesting_depth) + key
+        with self.lock:
+            s = self.rendered.get(key)
+            if s is not None:
+                self.rendered.move_to_end(key)
+        if s is not None:
+            output_stream.write(s)
+            return
+
+        block_stream = io.StringIO()
+        block.close(block_stream)
+        s = block_stream.getvalue()
+        output_stream.write(s)
+        if len(s) <= self.max_size:
+            with self.lock:
+                if key not in self.rendered:
+                    self.rendered[key] = s
+                    self.size += len(s)
+                while self.size > self.max_size:
+                    _, old_s = self.rendered.popitem(last=False)
+                    self.size -= len(old_s)
+
+
+@functools.lru_cache(maxsize=None)
+def shared_block_memo(max_size):
+    """
+    A BlockMemo for each size, shared by all the pages a process converts.
+    """
+    return BlockMemo(max_size)
+
+
+class Profile:
+    """
+    Time and call counts for the stages of a conversion, for finding
+    out why a page is slow:
+
+        profile = Profile()
+        html = Renderer().render(text, profile=profile)
+        profile.write(sys.stderr)
+
+    The time of a stage excludes the stages nested in it: *block* is
+    reading lines and finding blocks, *lex* is str_lex and token_lex,
+    *parse* is InlineParser.parse and *render* is closing blocks and
+    writing table rows, which includes turning inline trees into HTML.
+    Block types, line ranges and the slowest blocks get their total
+    time.
+    """
+    def __init__(self, line_range=PROFILE_LINE_RANGE, slowest_block_cnt=PROFILE_SLOWEST_BLOCKS):
+        self.line_range = line_range
+        self.slowest_block_cnt = slowest_block_cnt
+        self.stages = collections.defaultdict(lambda: [0, 0.0])
+        self.block_types = collections.defaultdict(lambda: [0, 0.0])
+        self.line_ranges = collections.defaultdict(float)
+        self.slowest_blocks = []
+        self.block_cnt = 0
+        self.streamed = 0.0
+        self.stack = []
+        self.last = None
+
+    def enter(self, stage):
+        now = time.perf_counter()
+        if self.stack:
+            self.stages[self.stack[-1]][1] += now - self.last
+        self.stack.append(stage)
+        self.stages[stage][0] += 1
+        self.last = now
+
+        return now
+
+    def leave(self):
+        now = time.perf_counter()
+        self.stages[self.stack.pop()][1] += now - self.last
+        self.last = now
+
+        return now
+
+    def run_line(self, lineno, func, *args):
+        start = self.enter('block')
+        try:
+            func(*args)
+        finally:
+            self.line_ranges[max(lineno - 1, 0) // self.line_range] += self.leave() - start
+
+    def write_rows(self, block_parser, output_stream):
+        start = self.enter('render')
+        try:
+            block_parser.current_block.write_rows(output_stream)
+        finally:
+            self.streamed += self.leave() - start
+
+    def close_block(self, block_parser, output_stream):
+        block = block_parser.current_block
+        start = self.enter('render')
+        try:
+            block_parser.close_block(output_stream)
+        finally:
+            elapsed = self.leave() - start + self.streamed
+            self.streamed = 0.0
+            counts = self.block_types[type(block).__name__]
+            counts[0] += 1
+            counts[1] += elapsed
+            self.block_cnt += 1
+            entry = (elapsed, self.block_cnt, type(block).__name__, block.first_lineno, block.last_lineno)
+            if len(self.slowest_blocks) < self.slowest_block_cnt:
+                heapq.heappush(self.slowest_blocks, entry)
+            else:
+                heapq.heappushpop(self.slowest_blocks, entry)
+
+    def parse(self, parser, tokens):
+        self.enter('lex')
+        try:
+            tokens = list(tokens)
+        finally:
+            self.leave()
+        self.enter('parse')
+        try:
+            return parser.parse_tokens(tokens)
+        finally:
+            self.leave()
+
+    def report(self):
+        def counts(table):
+            return {name: {'calls': calls, 'seconds': seconds}
+                    for name, (calls, seconds) in sorted(table.items())}
+
+        return {
+            'stages': counts(self.stages),
+            'block_types': counts(self.block_types),
+            'line_ranges': [{'first_line': i * self.line_range + 1,
+                             'last_line': (i + 1) * self.line_range,
+                             'seconds': seconds}
+                            for i, seconds in sorted(self.line_ranges.items())],
+            'slowest_blocks': [{'type': block_type,
+                                'first_line': first_line,
+                                'last_line': last_line,
+                                'seconds': seconds}
+                               for seconds, _, block_type, first_line, last_line
+                               in sorted(self.slowest_blocks, reverse=True)],
+        }
+
+    def write(self, output_stream):
+        json.dump(self.report(), output_stream, indent=2)
+        output_stream.write('\n')
 
 
 class Wikidot:
-    def __init__(self, args):
+    def __init__(self, args, block_memo=None, profile=None):
         self.image_prefix = args.image_prefix
         self.link_prefix = args.link_prefix
         self.link_suffix = args.link_suffix
+        self.block_memo = block_memo
+        self.profile = profile
+        self.max_line_length = getattr(args, 'max_line_length', MAX_LINE_LENGTH)
+        self.max_line_tokens = getattr(args, 'max_line_tokens', MAX_LINE_TOKENS)
+        self.max_nesting_depth = getattr(args, 'max_nesting_depth', MAX_NESTING_DEPTH)
+        self.output_buffer_size = getattr(args, 'output_buffer_size', OUTPUT_BUFFER_SIZE)
         self.LINE_BREAK = LineBreak(self)
         self.toc = TOC(self)
         self.next_toc_number = 0
@@ -1774,6 +2453,548 @@ class Wikidot:
         BlockParser(self, input_stream).process_lines(output_stream)
 
 
+def split_lines(text):
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode('utf-8')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+
+    return lines
+
+
+class StringOutputStream:
+    def __init__(self):
+        self.fragments = []
+        self.write = self.fragments.append
+
+    def getvalue(self):
+        return ''.join(self.fragments)
+
+
+class Renderer:
+    """
+    Renders Wikidot markup to HTML with a fixed configuration:
+
+        renderer = Renderer(link_prefix='/wiki')
+        html = renderer.render('Some **bold** text.')
+
+    Every call gets its own Wikidot object, so a Renderer may be shared
+    by threads.  With *block_memo_size*, rendered blocks are reused
+    across calls; see BlockMemo.  The max_* limits bound the work done
+    on a pathological line; see InlineParser.parse_line.
+    """
+    def __init__(self, *, image_prefix='', link_prefix='', link_suffix='', block_memo_size=0,
+                 max_line_length=MAX_LINE_LENGTH, max_line_tokens=MAX_LINE_TOKENS, max_nesting_depth=MAX_NESTING_DEPTH):
+        self.image_prefix = image_prefix
+        self.link_prefix = link_prefix
+        self.link_suffix = link_suffix
+        self.max_line_length = max_line_length
+        self.max_line_tokens = max_line_tokens
+        self.max_nesting_depth = max_nesting_depth
+        self.block_memo = BlockMemo(block_memo_size) if block_memo_size else None
+
+    def render(self, text, profile=None, toc=None):
+        """
+        *text* is a str, or bytes in UTF-8.  Lines are split on newlines
+        only, as when reading the markup from a file.  With a *profile*,
+        the time spent on the page is added to it; see Profile.  With a
+        *toc* list, a TocEntry for each heading is appended to it.
+        """
+        output_stream = StringOutputStream()
+        wikidot = Wikidot(self, self.block_memo, profile)
+        wikidot.to_html(split_lines(text), output_stream)
+        if toc is not None:
+            toc.extend(wikidot.toc.headers)
+
+        return output_stream.getvalue()
+
+
+def render(text, *, image_prefix='', link_prefix='', link_suffix=''):
+    return Renderer(image_prefix=image_prefix,
+                    link_prefix=link_prefix,
+                    link_suffix=link_suffix).render(text)
+
+
+class DocumentSegment:
+    """
+    The output of the lines of a document from one restart point up to
+    the next, and the parser state at its start.  It is the output
+    stream for those lines; the TOC placeholder is kept in place.
+    """
+    def __init__(self, start, divs, next_toc_number, next_eqn_number):
+        self.start = start
+        self.divs = divs
+        self.next_toc_number = next_toc_number
+        self.next_eqn_number = next_eqn_number
+        self.fragments = []
+        self.write = self.fragments.append
+        self.write_placeholder = self.fragments.append
+        self.headers = []
+
+    def same_state(self, other):
+        return (len(self.divs) == len(other.divs) and
+                self.next_toc_number == other.next_toc_number and
+                self.next_eqn_number == other.next_eqn_number)
+
+
+class IncrementalDocument:
+    """
+    A rendered document which is kept up to date as ranges of lines are
+    replaced, as in an editor preview:
+
+        document = IncrementalDocument(text)
+        html = document.edit(10, 12, 'replacement lines\n')
+
+    The document is kept as segments split at the points where no block
+    is open: after a blank line, a [[/div]] or the end of a code, math or
+    html block.  An edit is parsed from the last restart point before it
+    up to the first restart point after it where the parser is in the
+    same state as before the edit; the segments after that are reused.
+    """
+    def __init__(self, text, renderer=None):
+        self.renderer = renderer or Renderer()
+        self.wikidot = Wikidot(self.renderer, self.renderer.block_memo)
+        self.toc = TOC(self.wikidot)
+        self.lines = split_lines(text)
+        self.segments = []
+        self.reparsed_line_cnt = 0
+        self.render_from(DocumentSegment(0, [], 0, 1), [], 0, 0)
+
+    def render_from(self, segment, old_segments, delta, resync_start):
+        """
+        Parses the lines from the start of *segment*.  At a restart point
+        at or after *resync_start* where one of *old_segments*, shifted by
+        *delta* lines, starts in the same state, that segment and those
+        after it are reused.
+        """
+        wikidot = self.wikidot
+        wikidot.next_toc_number = segment.next_toc_number
+        wikidot.next_eqn_number = segment.next_eqn_number
+        wikidot.toc = TOC(wikidot)
+        parser = BlockParser(wikidot, None)
+        parser.divs = list(segment.divs)
+        parser.toc = self.toc
+        old_starts = {old_segment.start + delta: i for i, old_segment in enumerate(old_segments)}
+        lines = self.lines
+        i = segment.start
+        self.reparsed_line_cnt = 0
+        try:
+            while i < len(lines):
+                parser.process_line(segment, i + 1, lines[i])
+                i += 1
+                self.reparsed_line_cnt += 1
+                if not parser.at_restart_point():
+                    continue
+                segment.headers = wikidot.toc.headers
+                self.segments.append(segment)
+                segment = DocumentSegment(i, list(parser.divs), wikidot.next_toc_number, wikidot.next_eqn_number)
+                if i >= resync_start and i in old_starts:
+                    j = old_starts[i]
+                    if old_segments[j].same_state(segment):
+                        for old_segment in old_segments[j:]:
+                            old_segment.start += delta
+                            self.segments.append(old_segment)
+                        return
+                wikidot.toc = TOC(wikidot)
+            parser.finish(segment)
+        except Exception:
+            sys.stderr.write("ERROR at line {}: {}\n".format(i + 1, lines[i].rstrip() if i < len(lines) else ''))
+            raise
+        segment.headers = wikidot.toc.headers
+        self.segments.append(segment)
+
+    def edit(self, start, end, text):
+        """
+        Replaces lines *start* up to *end*, counting from zero, with the
+        lines of *text*, and returns the new HTML.
+        """
+        new_lines = split_lines(text)
+        self.lines[start:end] = new_lines
+        delta = len(new_lines) - (end - start)
+        j = bisect.bisect_right([segment.start for segment in self.segments], start) - 1
+        restart = self.segments[j]
+        old_segments = [segment for segment in self.segments[j + 1:] if segment.start >= end]
+        del self.segments[j:]
+        self.render_from(DocumentSegment(restart.start,
+                                         restart.divs,
+                                         restart.next_toc_number,
+                                         restart.next_eqn_number),
+                         old_segments,
+                         delta,
+                         start + len(new_lines))
+
+        return self.html()
+
+    def toc_entries(self):
+        """
+        The TocEntry of each heading, kept with the segments, so no line
+        is parsed again.
+        """
+        return [header for segment in self.segments for header in segment.headers]
+
+    def html(self):
+        self.toc.headers = self.toc_entries()
+        output_stream = StringOutputStream()
+        write = output_stream.write
+        for segment in self.segments:
+            for fragment in segment.fragments:
+                if isinstance(fragment, str):
+                    write(fragment)
+                else:
+                    fragment.close(output_stream)
+
+        return output_stream.getvalue()
+
+
+def convert_file(wikidot, input_path, output_path):
+    with open(input_path, encoding='utf-8') as input_stream, \
+            open(output_path, 'w', encoding='utf-8') as output_stream:
+        try:
+            wikidot.to_html(input_stream, output_stream)
+        except Exception:
+            sys.stderr.write("ERROR in file: {}\n".format(input_path))
+            raise
+
+
+def mapped_lines(input_path, chunk_size=MMAP_CHUNK_SIZE):
+    """
+    Yields the lines of the UTF-8 file at *input_path*, split on newlines
+    only, from a memory map.  About *chunk_size* bytes of whole lines
+    are decoded at a time, and the pages read are dropped from memory
+    where the platform allows, so only a chunk is held, whatever the
+    size of the file.
+    """
+    dont_need = getattr(mmap, 'MADV_DONTNEED', None)
+    with open(input_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            start = 0
+            while start < size:
+                end = start + chunk_size
+                if end < size:
+                    end = mm.rfind(b'\n', start, end) + 1
+                    if end <= start:
+                        end = mm.find(b'\n', start + chunk_size) + 1 or size
+                else:
+                    end = size
+                lines = mm[start:end].decode('utf-8').split('\n')
+                if lines[-1] == '':
+                    lines.pop()
+                yield from lines
+                start = end
+                if dont_need is not None and start >= mmap.PAGESIZE:
+                    mm.madvise(dont_need, 0, start - start % mmap.PAGESIZE)
+
+
+def wikidot_paths(input_dir, output_dir):
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            root, ext = os.path.splitext(filename)
+            if ext != '.wikidot':
+                continue
+            relative_dir = os.path.relpath(dirpath, input_dir)
+            yield (os.path.join(dirpath, filename),
+                   os.path.normpath(os.path.join(output_dir, relative_dir, root + '.html')))
+
+
+def overlapping(dir_a, dir_b):
+    """Whether *dir_a* and *dir_b* are the same or one is inside the other."""
+    dir_a = os.path.realpath(dir_a)
+    dir_b = os.path.realpath(dir_b)
+
+    return os.path.commonpath([dir_a, dir_b]) in (dir_a, dir_b)
+
+
+class RenderCache:
+    """
+    An on-disk cache of rendered pages for batch conversion.  Entries
+    are keyed on a hash of the page source, the Wikidot options and the
+    source of this converter, so any change to one of them is a miss.
+    Entries are files, which may be shared by worker processes; their
+    modification time records the last use, and evict() removes the
+    least recently used entries once the cache exceeds *max_size* bytes.
+    """
+    def __init__(self, cache_dir, max_size=CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        with open(__file__, 'rb') as f:
+            self.converter_version = hashlib.sha256(f.read()).hexdigest()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, args, input_path):
+        digest = hashlib.sha256()
+        for value in [self.converter_version,
+                      args.image_prefix,
+                      args.link_prefix,
+                      args.link_suffix,
+                      str(getattr(args, 'max_line_length', MAX_LINE_LENGTH)),
+                      str(getattr(args, 'max_line_tokens', MAX_LINE_TOKENS)),
+                      str(getattr(args, 'max_nesting_depth', MAX_NESTING_DEPTH))]:
+            digest.update(value.encode('utf-8', 'surrogatepass'))
+            digest.update(b'\0')
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CACHE_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.html')
+
+    def get(self, key, output_path):
+        path = self.path(key)
+        try:
+            shutil.copyfile(path, output_path)
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def put(self, key, output_path):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(output_path, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def entries(self):
+        """
+        Yields the paths of the files which path() and put() write, so
+        nothing else under *cache_dir* is ever counted or evicted.
+        """
+        for dirname in os.listdir(self.cache_dir):
+            dirpath = os.path.join(self.cache_dir, dirname)
+            if not RX_CACHE_DIR.match(dirname) or not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                m = RX_CACHE_FILE.match(filename)
+                if m is None:
+                    continue
+                if m.group('key') is not None and m.group('key')[:2] != dirname:
+                    continue
+                yield os.path.join(dirpath, filename)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        if os.path.isdir(self.cache_dir):
+            for path in self.entries():
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            os.unlink(path)
+            total_size -= size
+
+
+def page_wikidot(args, profile=None):
+    block_memo_size = getattr(args, 'block_memo_size', 0)
+    if block_memo_size:
+        return Wikidot(args, shared_block_memo(block_memo_size), profile)
+
+    return Wikidot(args, profile=profile)
+
+
+def convert_page(args, input_path, output_path, cache=None):
+    """
+    Returns the size of the input and whether the page was found in
+    *cache*, or None if there is no cache.
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    if cache is None:
+        convert_file(page_wikidot(args), input_path, output_path)
+        return os.path.getsize(input_path), None
+
+    key = cache.key(args, input_path)
+    if cache.get(key, output_path):
+        return os.path.getsize(input_path), True
+    convert_file(page_wikidot(args), input_path, output_path)
+    cache.put(key, output_path)
+
+    return os.path.getsize(input_path), False
+
+
+def convert_tree(args, input_dir, output_dir, jobs=1, cache=None):
+    """
+    Converts every .wikidot file under *input_dir* to an .html file at
+    the same relative path under *output_dir*.  Each page gets a fresh
+    Wikidot object; with *jobs* > 1 the pages are converted by a pool of
+    worker processes.  Unchanged pages are copied from *cache* if given.
+
+    Returns the number of pages, the number of input bytes and the
+    elapsed time.
+    """
+    start = time.perf_counter()
+    paths = list(wikidot_paths(input_dir, output_dir))
+    input_paths = [input_path for input_path, _ in paths]
+    output_paths = [output_path for _, output_path in paths]
+    if jobs == 1:
+        results = list(map(convert_page,
+                           itertools.repeat(args),
+                           input_paths,
+                           output_paths,
+                           itertools.repeat(cache)))
+    else:
+        chunksize = max(1, len(paths) // (jobs * 8))
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(convert_page,
+                                        itertools.repeat(args),
+                                        input_paths,
+                                        output_paths,
+                                        itertools.repeat(cache),
+                                        chunksize=chunksize))
+    if cache is not None:
+        cache.hits += sum(1 for _, hit in results if hit)
+        cache.misses += sum(1 for _, hit in results if not hit)
+        cache.evict()
+
+    return len(paths), sum(byte_cnt for byte_cnt, _ in results), time.perf_counter() - start
+
+
+def write_summary(page_cnt, byte_cnt, elapsed):
+    sys.stderr.write(
+        'converted {} pages ({} bytes) in {:.3f}s: {:.1f} pages/sec, {:.0f} bytes/sec\n'.format(
+            page_cnt,
+            byte_cnt,
+            elapsed,
+            page_cnt / elapsed if elapsed else 0.0,
+            byte_cnt / elapsed if elapsed else 0.0))
+
+
+class LatencyStats:
+    """
+    Render times of the most recent *max_samples* requests.
+    """
+    def __init__(self, max_samples=LATENCY_SAMPLES):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+        d = {'requests': count}
+        for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+            if samples:
+                i = min(len(samples) - 1, max(0, math.ceil(fraction * len(samples)) - 1))
+                d[name + '_ms'] = round(samples[i] * 1000, 3)
+            else:
+                d[name + '_ms'] = None
+
+        return d
+
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST markup to any path to get the HTML back; GET /stats for the
+    latency percentiles as JSON.
+    """
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        text = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        start = time.perf_counter()
+        try:
+            body = self.server.renderer.render(text).encode('utf-8')
+        except Exception as e:  # pylint: disable=broad-except
+            self.send_error(500, 'render failed: {}'.format(e))
+            return
+        self.server.latency.add(time.perf_counter() - start)
+        self.send_body('text/html; charset=utf-8', body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        self.send_body('application/json', json.dumps(self.server.latency.summary()).encode('utf-8'))
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class PooledMixIn(socketserver.ThreadingMixIn):
+    """
+    Handles requests on a fixed pool of threads rather than a thread
+    per request.
+    """
+    daemon_threads = True
+    executor = None
+
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(SERVE_THREADS)
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class RenderServer(PooledMixIn, http.server.HTTPServer):
+    pass
+
+
+class UnixRenderServer(PooledMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def make_server(address, renderer):
+    """
+    *address* is HOST:PORT, or the path of a Unix socket if it contains
+    a slash.
+    """
+    if '/' in address:
+        server = UnixRenderServer(address, RenderRequestHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = RenderServer((host or 'localhost', int(port)), RenderRequestHandler)
+    server.renderer = renderer
+    server.latency = LatencyStats()
+
+    return server
+
+
+def serve(address, renderer):
+    server = make_server(address, renderer)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write('serving on {}\n'.format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server, UnixRenderServer):
+            os.unlink(address)
+        sys.stderr.write('{}\n'.format(json.dumps(server.latency.summary())))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--image-prefix',
@@ -1785,5 +3006,112 @@ if __name__ == '__main__':
     parser.add_argument('--link-suffix',
                         dest='link_suffix',
                         default='')
+    parser.add_argument('--input',
+                        dest='input',
+                        default=None,
+                        metavar='FILE',
+                        help='read the page from FILE, memory-mapped, instead of stdin')
+    parser.add_argument('--input-dir',
+                        dest='input_dir',
+                        default=None)
+    parser.add_argument('--output-dir',
+                        dest='output_dir',
+                        default=None)
+    parser.add_argument('--jobs',
+                        dest='jobs',
+                        type=int,
+                        default=1,
+                        help='worker processes for --input-dir; 0 for one per CPU')
+    parser.add_argument('--cache-dir',
+                        dest='cache_dir',
+                        default=None,
+                        help='reuse pages rendered by earlier --input-dir runs')
+    parser.add_argument('--cache-max-size',
+                        dest='cache_max_size',
+                        type=int,
+                        default=CACHE_MAX_SIZE // (1024 * 1024),
+                        help='megabytes')
+    parser.add_argument('--block-memo-size',
+                        dest='block_memo_size',
+                        type=int,
+                        default=0,
+                        help='characters of rendered blocks to reuse; 0 to disable')
+    parser.add_argument('--serve',
+                        dest='serve',
+                        default=None,
+                        metavar='ADDRESS',
+                        help='serve renders over HTTP on HOST:PORT or a Unix socket path')
+    parser.add_argument('--max-line-length',
+                        dest='max_line_length',
+                        type=int,
+                        default=MAX_LINE_LENGTH,
+                        help='characters; longer lines of inline content are escaped, not parsed')
+    parser.add_argument('--max-line-tokens',
+                        dest='max_line_tokens',
+                        type=int,
+                        default=MAX_LINE_TOKENS,
+                        help='tokens parsed per line; the rest of the line is escaped')
+    parser.add_argument('--max-nesting-depth',
+                        dest='max_nesting_depth',
+                        type=int,
+                        default=MAX_NESTING_DEPTH,
+                        help='open inline elements; deeper [[span]] and [[size]] tags are escaped')
+    parser.add_argument('--output-buffer-size',
+                        dest='output_buffer_size',
+                        type=int,
+                        default=OUTPUT_BUFFER_SIZE,
+                        help='characters of output gathered before a write; 0 to write each piece')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        nargs='?',
+                        const='-',
+                        default=None,
+                        metavar='FILE',
+                        help='write time spent per stage, block type and line range as JSON to FILE or stderr')
     args = parser.parse_args()
-    Wikidot(args).to_html(sys.stdin, sys.stdout)
+    if (args.input_dir is None) != (args.output_dir is None):
+        parser.error('--input-dir and --output-dir must be used together')
+    if args.jobs < 0:
+        parser.error('--jobs must not be negative')
+    if args.cache_dir is not None and args.input_dir is None:
+        parser.error('--cache-dir requires --input-dir')
+    if args.cache_dir is not None and args.output_dir is not None and \
+       overlapping(args.cache_dir, args.output_dir):
+        parser.error('--cache-dir and --output-dir must not overlap')
+    if args.serve is not None and args.input_dir is not None:
+        parser.error('--serve and --input-dir cannot be used together')
+    if args.input is not None and (args.serve is not None or args.input_dir is not None):
+        parser.error('--input cannot be used with --serve or --input-dir')
+    if args.profile is not None and (args.serve is not None or args.input_dir is not None):
+        parser.error('--profile converts a single page from stdin or --input')
+    input_stream = sys.stdin if args.input is None else mapped_lines(args.input)
+    if args.serve is not None:
+        serve(args.serve, Renderer(image_prefix=args.image_prefix,
+                                   link_prefix=args.link_prefix,
+                                   link_suffix=args.link_suffix,
+                                   block_memo_size=args.block_memo_size,
+                                   max_line_length=args.max_line_length,
+                                   max_line_tokens=args.max_line_tokens,
+                                   max_nesting_depth=args.max_nesting_depth))
+    elif args.input_dir is not None:
+        render_cache = None
+        if args.cache_dir is not None:
+            render_cache = RenderCache(args.cache_dir, args.cache_max_size * 1024 * 1024)
+        write_summary(*convert_tree(args,
+                                    args.input_dir,
+                                    args.output_dir,
+                                    args.jobs or os.cpu_count(),
+                                    render_cache))
+        if render_cache is not None:
+            sys.stderr.write('cache: {} hits, {} misses\n'.format(render_cache.hits,
+                                                                  render_cache.misses))
+    elif args.profile is not None:
+        page_profile = Profile()
+        page_wikidot(args, page_profile).to_html(input_stream, sys.stdout)
+        if args.profile == '-':
+            page_profile.write(sys.stderr)
+        else:
+            with open(args.profile, 'w') as f:
+                page_profile.write(f)
+    else:
+        page_wikidot(args).to_html(input_stream, sys.stdout)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Checks that the library API renders every page in test/input, as str
+and as bytes, and from several threads at once, the same as the
+command line, whose output is expected in the directory given as the
+only argument, and that the headings of a page are returned as TOC
+entries.
+"""
+
+import concurrent.futures
+import os
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'src'))
+
+import wikidot_to_html  # noqa: E402  pylint: disable=wrong-import-position
+
+TOC_ENTRIES = [
+    (1, 'toc0', 'First <em>header</em>'),
+    (2, 'toc1', 'Second <strong>header</strong>'),
+    (3, 'toc2', 'Third header with <a href="http://foo.com">a link</a>'),
+]
+
+
+def pages(expected_dir):
+    input_dir = os.path.join(TEST_DIR, 'input')
+    for name in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, name), 'rb') as f:
+            source = f.read()
+        with open(os.path.join(expected_dir, name.replace('.wikidot', '.html')), encoding='utf-8') as f:
+            expected = f.read()
+        yield name, source, expected
+
+
+def main():
+    ok = True
+    renderer = wikidot_to_html.Renderer(block_memo_size=1000000)
+    all_pages = list(pages(sys.argv[1])) * 4
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        str_results = executor.map(lambda page: wikidot_to_html.render(page[1].decode('utf-8')), all_pages)
+        bytes_results = executor.map(lambda page: renderer.render(page[1]), all_pages)
+        for (name, _, expected), str_result, bytes_result in zip(all_pages, str_results, bytes_results):
+            if str_result != expected or bytes_result != expected:
+                sys.stderr.write('MISMATCH: {}\n'.format(name))
+                ok = False
+
+    with open(os.path.join(TEST_DIR, 'input', 'toc.wikidot'), encoding='utf-8') as f:
+        text = f.read()
+    toc = []
+    renderer.render(text, toc=toc)
+    if toc != TOC_ENTRIES or wikidot_to_html.IncrementalDocument(text).toc_entries() != TOC_ENTRIES:
+        sys.stderr.write('TOC entries differ: {}\n'.format(toc))
+        ok = False
+
+    if not ok:
+        sys.exit(1)
+    print('render matches the command line')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Checks that an IncrementalDocument renders the same as the library API
+after each of a series of random edits to the pages in test/input, and
+that an edit far from the start of a long page reparses only a few
+lines.
+"""
+
+import io
+import os
+import random
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'src'))
+
+import wikidot_to_html  # noqa: E402  pylint: disable=wrong-import-position
+
+EDIT_CNT = 500
+
+
+def corpus_lines():
+    input_dir = os.path.join(TEST_DIR, 'input')
+    lines = []
+    for name in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, name), encoding='utf-8') as f:
+            lines.extend(wikidot_to_html.split_lines(f.read()))
+
+    return lines
+
+
+def renders(text):
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        return wikidot_to_html.render(text)
+    except Exception:  # pylint: disable=broad-except
+        return None
+    finally:
+        sys.stderr = stderr
+
+
+def random_edit(rnd, lines, pool):
+    start = rnd.randint(0, len(lines))
+    end = min(len(lines), start + rnd.choice([0, 0, 1, 1, 2, 5]))
+    new_lines = [rnd.choice(pool) for _ in range(rnd.choice([0, 1, 1, 2, 3]))]
+
+    return start, end, ''.join(line + '\n' for line in new_lines)
+
+
+def main():
+    rnd = random.Random(13)
+    pool = corpus_lines()
+    text = '\n'.join(pool) + '\n'
+    document = wikidot_to_html.IncrementalDocument(text)
+    ok = document.html() == renders(text)
+    edit_cnt = 0
+    while edit_cnt < EDIT_CNT:
+        start, end, new_text = random_edit(rnd, document.lines, pool)
+        lines = document.lines[:start] + wikidot_to_html.split_lines(new_text) + document.lines[end:]
+        expected = renders(''.join(line + '\n' for line in lines))
+        if expected is None:
+            continue
+        edit_cnt += 1
+        if document.edit(start, end, new_text) != expected:
+            sys.stderr.write('MISMATCH after edit {}: lines {}-{} replaced by {!r}\n'.format(edit_cnt, start, end, new_text))
+            ok = False
+            break
+
+    long_document = wikidot_to_html.IncrementalDocument(text * 10)
+    middle = len(long_document.lines) // 2
+    long_document.edit(middle, middle + 1, 'An **edited** line.\n')
+    if long_document.reparsed_line_cnt > 100:
+        sys.stderr.write('edit reparsed {} lines\n'.format(long_document.reparsed_line_cnt))
+        ok = False
+
+    if not ok:
+        sys.exit(1)
+    print('incremental render matches the library API')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Differential test for the lexers: str_lex and token_lex must generate
+the same tokens as the original character-at-a-time implementations,
+which are kept below as reference_str_lex and reference_token_lex, for
+every line in test/input and for random input.
+"""
+
+import os
+import random
+import re
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'src'))
+
+from wikidot_to_html import (  # noqa: E402  pylint: disable=wrong-import-position
+    HTML_ENTITY_LITERAL_END_TOKEN,
+    HTML_ENTITY_LITERAL_START_TOKEN,
+    LITERAL_END_TOKEN,
+    LITERAL_START_TOKEN,
+    str_lex,
+    token_lex)
+
+REF_TRIPLE_BRACKET = re.compile(
+    r'(?P<token>^\[\[\[[^\]|]+(\|[^\]|]+)?\]\]\])(?P<text>.*)$')
+REF_DOUBLE_BRACKET = re.compile(
+    r'^(?P<token>\[\[[^\]]+\]\])(?P<text>.*)$')
+REF_SINGLE_BRACKET = re.compile(
+    r'^(?P<token>\[(?P<head>[^\]\s]+)[^\]]*\])(?P<text>.*)$')
+REF_ESCAPE_CHAR = re.compile(r'@|<|>')
+REF_DOUBLED_CHAR = re.compile(
+    r'^(//|\*\*|\{\{|\}\}|--|__|,,|\^\^|\|\|)')
+REF_COLOR_HEAD = re.compile(r'^(?P<token>##[a-zA-Z][a-zA-Z0-9 ]*\|)'
+                            '(?P<text>.*)$')
+REF_LEAD_WHITESPACE = re.compile(r'^(?P<token>\s+)(?P<text>.*)$')
+REF_URL_FRAGMENT = re.compile(r'^#[a-zA-Z0-9][a-zA-Z0-9-_]*$')
+REF_URL = re.compile(
+    r'^(?P<token>https?://[a-zA-Z0-9-._~:/#&?=+,;]*[a-zA-Z0-9-_~/#&?=+])'
+    r'(?P<text>.*)$')
+
+
+def reference_str_lex(text):
+    tokens = []
+    prefix_and_text = text
+    prefix = ''
+    text_i = 0
+    while text:
+        if text.startswith('['):
+            if text.startswith('[!--'):
+                tokens.append('[!--')
+                prefix_and_text = text[4:]
+                text = prefix_and_text
+                text_i = 0
+                continue
+            md = REF_TRIPLE_BRACKET.search(text)
+            if md:
+                if prefix:
+                    tokens.append(prefix)
+                    prefix = ''
+                tokens.append(md.group('token'))
+                prefix_and_text = md.group('text')
+                text = prefix_and_text
+                text_i = 0
+                continue
+            md = REF_DOUBLE_BRACKET.search(text)
+            if md:
+                if prefix:
+                    tokens.append(prefix)
+                    prefix = ''
+                tokens.append(md.group('token'))
+                prefix_and_text = md.group('text')
+                text = prefix_and_text
+                text_i = 0
+                continue
+            md = REF_SINGLE_BRACKET.search(text)
+            if md:
+                head = md.group('head')
+                if REF_URL.search(head) or REF_URL_FRAGMENT.search(head):
+                    if prefix:
+                        tokens.append(prefix)
+                        prefix = ''
+                    tokens.append(md.group('token'))
+                    prefix_and_text = md.group('text')
+                    text = prefix_and_text
+                    text_i = 0
+                    continue
+        if text.startswith('##'):
+            if prefix:
+                tokens.append(prefix)
+                prefix = ''
+            md = REF_COLOR_HEAD.search(text)
+            if md:
+                tokens.append(md.group('token'))
+                prefix_and_text = md.group('text')
+                text = prefix_and_text
+                text_i = 0
+                continue
+            tokens.append(text[0:2])
+            prefix_and_text = text[2:]
+            text = prefix_and_text
+            text_i = 0
+            continue
+        md = REF_LEAD_WHITESPACE.search(text)
+        if md:
+            if prefix:
+                tokens.append(prefix)
+                prefix = ''
+            tokens.append(md.group('token'))
+            prefix_and_text = md.group('text')
+            text = prefix_and_text
+            text_i = 0
+            continue
+        if text.startswith('--]'):
+            tokens.append('--]')
+            prefix_and_text = text[3:]
+            text = prefix_and_text
+            text_i = 0
+            continue
+        md = REF_ESCAPE_CHAR.search(text)
+        if md:
+            tokens.append(text[0:1])
+            prefix_and_text = text[1:]
+            text = prefix_and_text
+            text_i = 0
+            continue
+        md = REF_DOUBLED_CHAR.search(text)
+        if md:
+            if prefix:
+                tokens.append(prefix)
+                prefix = ''
+            tokens.append(text[0:2])
+            prefix_and_text = text[2:]
+            text = prefix_and_text
+            text_i = 0
+            continue
+        if text.startswith('http'):
+            md = REF_URL.search(text)
+            if md:
+                tokens.append(md.group('token'))
+                prefix_and_text = md.group('text')
+                text = prefix_and_text
+                text_i = 0
+                continue
+        text_i += 1
+        prefix = prefix_and_text[0:text_i]
+        text = prefix_and_text[text_i:]
+
+    if prefix:
+        tokens.append(prefix)
+
+    return tokens
+
+
+def reference_count_literal_escapes(str_tokens):
+    prev_s = ''
+    literal_cnt = 0
+    for s in str_tokens:
+        if prev_s + s == '@@':
+            literal_cnt += 1
+            prev_s = ''
+        else:
+            prev_s = s
+
+    return literal_cnt
+
+
+def reference_token_lex(text):
+    last_idx = -1
+    last_html_entity_idx = -1
+    prev_s = ''
+    str_tokens = reference_str_lex(text)
+    tokens = []
+    remaining_literal_cnt = reference_count_literal_escapes(str_tokens)
+
+    for s in str_tokens:
+        if prev_s + s == '@@' and last_idx > -1:
+            remaining_literal_cnt -= 1
+            tokens.append(LITERAL_END_TOKEN)
+            tokens[last_idx] = LITERAL_START_TOKEN
+            last_idx = -1
+            prev_s = ''
+        elif prev_s + s == '@@' and remaining_literal_cnt > 1:
+            remaining_literal_cnt -= 1
+            tokens.append('@@')
+            last_idx = len(tokens) - 1
+            prev_s = ''
+        elif prev_s + s == '@<':
+            tokens.append('@<')
+            if last_html_entity_idx == -1:
+                last_html_entity_idx = len(tokens) - 1
+            prev_s = ''
+        elif prev_s + s == '>@':
+            if last_html_entity_idx > -1:
+                tokens[last_html_entity_idx] = HTML_ENTITY_LITERAL_START_TOKEN
+                last_html_entity_idx = -1
+                tokens.append(HTML_ENTITY_LITERAL_END_TOKEN)
+                prev_s = ''
+            else:
+                tokens.append('>')
+                prev_s = '@'
+        elif s in {'@', '>'}:
+            if prev_s:
+                tokens.append(prev_s)
+            prev_s = s
+        else:
+            if prev_s:
+                tokens.append(prev_s)
+                prev_s = ''
+            tokens.append(s)
+
+    return tokens
+
+
+FRAGMENTS = ['[', ']', '[[', ']]', '[[[', ']]]', '[!--', '--]', '--', '-', '#', '##', '##red|',
+             '##12ab|', '|', '||', '@', '@@', '@<', '>@', '<', '>', '/', '//', '*', '**', '{{', '}}',
+             '__', ',,', '^^', ' ', '  ', '\t', 'h', 'http', 'http://', 'https://foo.com/a?b=c',
+             '[#frag ', '[http://x.com ', '[[# ', '[[span ', '[[/span]]', 'a', 'bc', 'word', 'é',
+             '=', '"', '.', ':', '~']
+
+
+def random_text(rng):
+    return ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 30)))
+
+
+def check_lexer(name, text, expected, actual):
+    if actual != expected:
+        sys.stderr.write('{} MISMATCH: {!r}\n  expected: {!r}\n  actual:   {!r}\n'.format(
+            name, text, expected, actual))
+        return False
+
+    return True
+
+
+def check(text):
+    ok = check_lexer('str_lex', text, reference_str_lex(text), list(str_lex(text)))
+    return check_lexer('token_lex', text, reference_token_lex(text), list(token_lex(text))) and ok
+
+
+def main():
+    ok = True
+    input_dir = os.path.join(TEST_DIR, 'input')
+    for name in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, name)) as f:
+            for line in f:
+                ok = check(line.rstrip()) and ok
+
+    rng = random.Random(0)
+    for _ in range(20000):
+        ok = check(random_text(rng)) and ok
+
+    if not ok:
+        sys.exit(1)
+    print('str_lex and token_lex match the reference lexers')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Starts the render server on a local TCP port and on a Unix socket,
+posts every page in test/input to each from several threads at once,
+and checks the responses against the command line output in the
+directory given as the only argument.  Then checks /stats.
+"""
+
+import concurrent.futures
+import http.client
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'src'))
+
+import wikidot_to_html  # noqa: E402  pylint: disable=wrong-import-position
+from api_test import pages  # noqa: E402  pylint: disable=wrong-import-position
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request(connect, method, body=None):
+    conn = connect()
+    try:
+        conn.request(method, '/stats' if method == 'GET' else '/', body=body)
+        response = conn.getresponse()
+        return response.status, response.read().decode('utf-8')
+    finally:
+        conn.close()
+
+
+def check_server(name, address, connect, all_pages):
+    ok = True
+    server = wikidot_to_html.make_server(address, wikidot_to_html.Renderer())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = executor.map(lambda page: request(connect(server), 'POST', page[1]), all_pages)
+            for (page_name, _, expected), (status, body) in zip(all_pages, results):
+                if status != 200 or body != expected:
+                    sys.stderr.write('{} MISMATCH: {}\n'.format(name, page_name))
+                    ok = False
+        status, body = request(connect(server), 'GET')
+        stats = json.loads(body)
+        if status != 200 or stats['requests'] != len(all_pages) or stats['p50_ms'] is None:
+            sys.stderr.write('{} BAD STATS: {}\n'.format(name, body))
+            ok = False
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    return ok
+
+
+def main():
+    all_pages = list(pages(sys.argv[1])) * 2
+    ok = check_server('tcp',
+                      'localhost:0',
+                      lambda server: lambda: http.client.HTTPConnection(*server.server_address),
+                      all_pages)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'render.sock')
+        ok = check_server('unix',
+                          path,
+                          lambda server: lambda: UnixHTTPConnection(path),
+                          all_pages) and ok
+
+    if not ok:
+        sys.exit(1)
+    print('render server matches the command line')
+
+
+if __name__ == '__main__':
+    main()
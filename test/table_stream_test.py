@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Checks that a table is written a row at a time: each row, including
+one with a multi-line cell, is in the output before the line after it
+is read, and the rows already read are not kept.
+"""
+
+import io
+import os
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..', 'src'))
+
+import wikidot_to_html  # noqa: E402  pylint: disable=wrong-import-position
+
+ROW_CNT = 1000
+
+
+def table_lines():
+    for n in range(ROW_CNT):
+        if n % 10 == 9:
+            yield '||multi {} _\n'.format(n)
+            yield 'line||cell {}||\n'.format(n)
+        else:
+            yield '||row {}||**cell** {}||\n'.format(n, n)
+
+
+def main():
+    output_stream = io.StringIO()
+    wikidot = wikidot_to_html.Wikidot(wikidot_to_html.Renderer())
+    block_parser = wikidot_to_html.BlockParser(wikidot, None)
+    ok = True
+    row_cnt = 0
+    for lineno, line in enumerate(table_lines(), start=1):
+        block_parser.process_line(output_stream, lineno, line)
+        if line.endswith('||\n'):
+            row_cnt += 1
+            if output_stream.getvalue().count('</tr>') != row_cnt:
+                sys.stderr.write('row {} not written after line {}\n'.format(row_cnt, lineno))
+                ok = False
+                break
+            if len(block_parser.current_block.lines) > 1:
+                sys.stderr.write('table keeps {} lines\n'.format(len(block_parser.current_block.lines)))
+                ok = False
+                break
+    block_parser.finish(output_stream)
+    expected = wikidot_to_html.render(''.join(table_lines()))
+    if output_stream.getvalue() != expected:
+        sys.stderr.write('streamed table differs from the library API\n')
+        ok = False
+
+    if not ok:
+        sys.exit(1)
+    print('tables are written a row at a time')
+
+
+if __name__ == '__main__':
+    main()